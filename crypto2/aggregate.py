@@ -0,0 +1,114 @@
+""" Homomorphic summation of large numbers of ciphertexts.
+
+    Ciphertexts are buffered into blocks; a block is folded into the
+    accumulator column by column, so the per-ciphertext work does not
+    allocate, and the accumulator is reduced once per block. Compressed
+    (seed, scalar), lazy (SeedSum, scalar) and uncompressed
+    ([seed vector], scalar) ciphertexts can be mixed freely. The result is
+    an uncompressed ciphertext that encryption.decrypt accepts. """
+import itertools
+
+import core
+from encryption import SeedSum
+from parameters import PARAMETERS
+
+class Accumulator(object):
+    """ usage: Accumulator(parameters=PARAMETERS, block_size=256) => accumulator
+
+        Sums ciphertexts in place: accumulator.add(ciphertext) or
+        accumulator.add_many(ciphertexts), then accumulator.result(). """
+
+    __slots__ = ("parameters", "block_size", "vector", "scalar", "count",
+                 "_seeds", "_vectors")
+
+    def __init__(self, parameters=PARAMETERS, block_size=256):
+        self.parameters = parameters
+        self.block_size = block_size
+        self.vector = [0] * parameters['n']
+        self.scalar = 0
+        self.count = 0
+        self._seeds = []
+        self._vectors = []
+
+    def add(self, ciphertext):
+        seed, scalar = ciphertext
+        if isinstance(seed, list) or isinstance(seed, tuple):
+            self._vectors.append(seed)
+        elif isinstance(seed, SeedSum):
+            self._seeds.extend(seed.seeds)
+        else:
+            self._seeds.append(seed)
+        self.scalar += scalar
+        self.count += 1
+        if len(self._seeds) + len(self._vectors) >= self.block_size:
+            self._flush()
+
+    def add_many(self, ciphertexts):
+        add = self.add
+        for ciphertext in ciphertexts:
+            add(ciphertext)
+        return self
+
+    def _flush(self):
+        q, n = self.parameters['q'], self.parameters['n']
+        vector = self.vector
+        if self._seeds:
+            for j, power_sum in enumerate(core.sum_of_powers(self._seeds, q, n)):
+                vector[j] += power_sum
+            self._seeds = []
+        if self._vectors:
+            for j, column in enumerate(zip(*self._vectors)):
+                vector[j] += sum(column)
+            self._vectors = []
+        self.vector = [x % q for x in vector]
+        self.scalar %= self.parameters['q']
+
+    def result(self):
+        self._flush()
+        return list(self.vector), self.scalar
+
+def chunks(iterable, size):
+    # yields lists of up to size items without materializing iterable
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def aggregate(ciphertexts, parameters=PARAMETERS, processes=0,
+              chunk_size=4096):
+    """ usage: aggregate(ciphertexts, parameters=PARAMETERS, processes=0,
+                         chunk_size=4096) => ciphertext
+
+        Returns the homomorphic sum of an iterable of ciphertexts.
+        With processes > 0 the input is split into chunk_size shards that are
+        summed in worker processes and merged here. """
+    if not processes:
+        return Accumulator(parameters).add_many(ciphertexts).result()
+    import parallel
+    with parallel.Executor(parameters, processes, chunk_size) as executor:
+        return executor.aggregate(ciphertexts)
+
+def test_aggregate():
+    import encryption
+    from utilities import random_vector_mod_q
+    print("Testing aggregate.py...")
+    q = PARAMETERS['q']
+    key = encryption.generate_secret_key()
+    messages = random_vector_mod_q(32, 2 ** 64, 300)
+    ciphertexts = [encryption.encrypt(key, message) for message in messages]
+    ciphertexts[10] = encryption.add_ciphertexts(ciphertexts[10], ciphertexts[11])
+    messages[10] += messages[11]
+    ciphertexts[11] = encryption.scale_ciphertext(encryption.encrypt(key, 1), 7)
+    messages[11] = 7
+    expected = sum(messages) % q
+    for block_size in (1, 64, 1024):
+        accumulator = Accumulator(block_size=block_size)
+        output = accumulator.add_many(iter(ciphertexts)).result()
+        assert accumulator.count == len(ciphertexts)
+        assert encryption.decrypt(key, output) == expected
+    assert encryption.decrypt(key, aggregate(ciphertexts, processes=2,
+                                             chunk_size=64)) == expected
+    assert aggregate([]) == ([0] * PARAMETERS['n'], 0)
+    print("Aggregate test complete")
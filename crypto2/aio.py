@@ -0,0 +1,425 @@
+""" asyncio front end for signing, verification and key encapsulation.
+
+    usage: python3 aio.py [--host HOST] [--port PORT] [--unix PATH]
+                          [--processes N] [--batch-size N] [--max-wait SECONDS]
+
+    Requests are queued per operation and grouped into micro-batches of up to
+    max_batch_size requests, or whatever arrived within max_wait seconds of
+    the first one. Each batch runs in a worker pool, so the event loop is
+    never blocked by the arithmetic, and the futures of its requests are
+    resolved when the batch completes. A full queue makes callers wait
+    (backpressure) instead of growing without bound.
+
+    Server protocol: one JSON object per line in each direction.
+        {"id": 1, "op": "sign", "message": HEX}
+        {"id": 2, "op": "verify", "public_key": HEX, "message": HEX,
+         "signature": HEX}
+        {"id": 3, "op": "encapsulate", "public_key": HEX}
+        {"id": 4, "op": "public_key"}
+    Keys and signatures are hex encoded serialized objects (see
+    signature.serialize_* and kem.serialize_*). Replies carry the request id
+    and either "result" or "error"; they may arrive out of order.
+    The server signs with a keypair generated at startup.
+
+    Requires python 3. """
+import argparse
+import asyncio
+import binascii
+import concurrent.futures
+import functools
+import json
+import os
+import sys
+
+import kem
+import parallel
+import signature
+from parameters import PARAMETERS
+
+OPERATIONS = ("sign", "verify", "encapsulate")
+
+def _sign_batch(items, parameters=None):
+    # items: [(private_key, message), ...]
+    parameters = parameters or parallel.worker_parameters()
+    prepared = {}
+    output = []
+    for private_key, message in items:
+        key = id(private_key)
+        if key not in prepared:
+            prepared[key] = signature.prepare_private_key(private_key, parameters)
+        output.append(signature.sign(prepared[key], message, parameters))
+    return output
+
+def _verify_batch(items, parameters=None):
+    # items: [(public_key, message, signature), ...]
+    parameters = parameters or parallel.worker_parameters()
+    return signature.verify_batch(items, parameters)
+
+def _encapsulate_batch(items, parameters=None):
+    # items: [(public_key, ), ...]
+    parameters = parameters or parallel.worker_parameters()
+    prepared = {}
+    output = []
+    for public_key, in items:
+        key = id(public_key)
+        if key not in prepared:
+            prepared[key] = kem.prepare_public_key(public_key, parameters)
+        output.append(kem.encapsulate_secret(prepared[key], parameters))
+    return output
+
+BATCH_FUNCTIONS = {"sign" : _sign_batch, "verify" : _verify_batch,
+                   "encapsulate" : _encapsulate_batch}
+
+class Service(object):
+    """ usage: Service(parameters=PARAMETERS, processes=None,
+                       max_batch_size=64, max_wait=.002,
+                       max_pending=4096) => service
+
+        async with Service() as service:
+            signed = await service.sign(private_key, message)
+
+        processes=None uses one worker process per cpu; processes=0 runs the
+        batches on a single worker thread instead. At most max_pending
+        requests per operation are queued, and at most two batches per
+        worker are in flight. Requests that have not run when the service
+        is closed fail with RuntimeError. """
+
+    def __init__(self, parameters=PARAMETERS, processes=None,
+                 max_batch_size=64, max_wait=.002, max_pending=4096):
+        self.parameters = parameters
+        self.processes = processes
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.batches = self.requests = 0
+        self.pool = None
+        self.closed = False
+        self._queues = {}
+        # the batch each collector is filling, kept here so close() can fail it
+        self._batches = {}
+        self._tasks = []
+        self._in_flight = set()
+        self._slots = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, _type, value, traceback):
+        await self.close()
+
+    async def start(self):
+        if self.processes == 0:
+            workers = 1
+            self.pool = concurrent.futures.ThreadPoolExecutor(workers)
+        else:
+            workers = self.processes or os.cpu_count() or 1
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=parallel._initialize,
+                initargs=(self.parameters, ))
+        self._slots = asyncio.Semaphore(2 * workers)
+        for operation in OPERATIONS:
+            self._queues[operation] = asyncio.Queue(self.max_pending)
+            self._batches[operation] = []
+            self._tasks.append(asyncio.ensure_future(self._collect(operation)))
+
+    async def close(self):
+        self.closed = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+        for operation in OPERATIONS:
+            # partial batches that never reached the pool, then the queues
+            self._fail(self._batches[operation])
+            self._batches[operation] = []
+            self._drain(operation)
+        self._tasks = []
+        self.pool.shutdown()
+
+    def _fail(self, batch):
+        for args, future in batch:
+            if not future.done():
+                future.set_exception(RuntimeError("Service closed"))
+
+    def _drain(self, operation):
+        queue = self._queues[operation]
+        while not queue.empty():
+            self._fail([queue.get_nowait()])
+
+    async def submit(self, operation, *args):
+        """ usage: await service.submit(operation, *args) => result
+
+            Queues one request; waits while the queue is full. """
+        if self.closed:
+            raise RuntimeError("Service closed")
+        future = asyncio.get_event_loop().create_future()
+        await self._queues[operation].put((args, future))
+        if self.closed:
+            # the put waited for space that close() made; nothing will run it
+            self._drain(operation)
+        self.requests += 1
+        return await future
+
+    async def sign(self, private_key, message):
+        return await self.submit("sign", private_key, message)
+
+    async def verify(self, public_key, message, signature):
+        return await self.submit("verify", public_key, message, signature)
+
+    async def encapsulate(self, public_key):
+        """ usage: await service.encapsulate(public_key) => (secret, cryptogram) """
+        return await self.submit("encapsulate", public_key)
+
+    async def _next_batch(self, operation):
+        loop = asyncio.get_event_loop()
+        queue = self._queues[operation]
+        batch = self._batches[operation]
+        batch.append(await queue.get())
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _collect(self, operation):
+        while True:
+            batch = await self._next_batch(operation)
+            await self._slots.acquire()
+            self._batches[operation] = []
+            task = asyncio.ensure_future(self._run(operation, batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _run(self, operation, batch):
+        function = BATCH_FUNCTIONS[operation]
+        if self.processes == 0:
+            function = functools.partial(function, parameters=self.parameters)
+        try:
+            results = await asyncio.get_event_loop().run_in_executor(
+                self.pool, function, [args for args, future in batch])
+        except Exception as error:
+            for args, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+        else:
+            for (args, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self.batches += 1
+            self._slots.release()
+
+def _unhex(text):
+    return binascii.unhexlify(text.encode("ascii"))
+
+def _hex(data):
+    return binascii.hexlify(bytes(data)).decode("ascii")
+
+class Handler(object):
+    """ usage: Handler(service, keypair=None,
+                       max_requests=256) => connection callback
+
+        Serves the line protocol for asyncio.start_server or
+        asyncio.start_unix_server. keypair is the (public, private)
+        signature keypair used for "sign" requests; one is generated if it is
+        not given. Each connection has at most max_requests requests
+        outstanding; reading pauses until replies are written. """
+
+    def __init__(self, service, keypair=None, max_requests=256):
+        self.service = service
+        self.parameters = service.parameters
+        self.public_key, self.private_key = (keypair or
+                                             signature.generate_keypair(self.parameters))
+        self.private_key = signature.prepare_private_key(self.private_key,
+                                                         self.parameters)
+        self.max_requests = max_requests
+
+    async def handle(self, request):
+        parameters = self.parameters
+        operation = request.get("op")
+        if operation == "sign":
+            signed = await self.service.sign(self.private_key,
+                                             _unhex(request["message"]))
+            return _hex(signature.serialize_signature(signed, parameters))
+        elif operation == "verify":
+            public_key = signature.deserialize_public_key(
+                _unhex(request["public_key"]), parameters)
+            signed = signature.deserialize_signature(
+                _unhex(request["signature"]), parameters)
+            return await self.service.verify(public_key,
+                                             _unhex(request["message"]), signed)
+        elif operation == "encapsulate":
+            public_key = kem.deserialize_public_key(
+                _unhex(request["public_key"]), parameters)
+            secret, cryptogram = await self.service.encapsulate(public_key)
+            return {"secret" : "{:x}".format(secret),
+                    "cryptogram" : _hex(kem.serialize_cryptogram(cryptogram,
+                                                                 parameters))}
+        elif operation == "public_key":
+            return _hex(signature.serialize_public_key(self.public_key,
+                                                       parameters))
+        raise ValueError("Unknown operation '{}'".format(operation))
+
+    async def _reply(self, line, writer, slots):
+        reply = {}
+        try:
+            request = json.loads(line.decode("utf-8"))
+            reply["id"] = request.get("id")
+            reply["result"] = await self.handle(request)
+        except Exception as error:
+            reply["error"] = "{}: {}".format(type(error).__name__, error)
+        finally:
+            slots.release()
+        writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+        await writer.drain()
+
+    async def __call__(self, reader, writer):
+        slots = asyncio.Semaphore(self.max_requests)
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await slots.acquire()
+                task = asyncio.ensure_future(self._reply(line, writer, slots))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            writer.close()
+
+async def start_server(service, host="127.0.0.1", port=0, path=None,
+                       keypair=None):
+    """ usage: await start_server(service, host="127.0.0.1", port=0,
+                                  path=None, keypair=None) => asyncio server
+
+        Listens on the Unix socket at path if it is given, otherwise on TCP
+        host:port. """
+    handler = Handler(service, keypair)
+    if path is not None:
+        return await asyncio.start_unix_server(handler, path)
+    return await asyncio.start_server(handler, host, port)
+
+async def serve(host="127.0.0.1", port=7272, path=None, processes=None,
+                max_batch_size=64, max_wait=.002, parameters=PARAMETERS):
+    async with Service(parameters, processes, max_batch_size,
+                       max_wait) as service:
+        server = await start_server(service, host, port, path)
+        address = path or "{}:{}".format(*server.sockets[0].getsockname()[:2])
+        sys.stderr.write("crypto2 service listening on {}\n".format(address))
+        async with server:
+            await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="crypto2 asyncio service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7272)
+    parser.add_argument("--unix")
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--max-wait", type=float, default=.002)
+    arguments = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(arguments.host, arguments.port, arguments.unix,
+                          arguments.processes, arguments.batch_size,
+                          arguments.max_wait))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def test_aio():
+    import tempfile
+    print("Testing aio.py...")
+
+    async def _request(reader, writer, request):
+        writer.write(json.dumps(request).encode("utf-8") + b"\n")
+        await writer.drain()
+        return json.loads((await reader.readline()).decode("utf-8"))
+
+    async def _test():
+        public, private = signature.generate_keypair()
+        kem_public, kem_private = kem.generate_keypair()
+        messages = ["message {}".format(count) for count in range(20)]
+        async with Service(processes=0, max_batch_size=8, max_wait=.05,
+                           max_pending=4) as service:
+            signatures = await asyncio.gather(*[service.sign(private, message)
+                                                for message in messages])
+            assert service.batches < len(messages)
+            checks = await asyncio.gather(*[service.verify(public, message, signed)
+                                            for message, signed in
+                                            zip(messages, signatures)])
+            assert checks == [True] * len(messages)
+            assert not await service.verify(public, "forged", signatures[0])
+            secret, cryptogram = await service.encapsulate(kem_public)
+            assert kem.recover_secret(kem_private, cryptogram) == secret
+
+            directory = tempfile.mkdtemp()
+            path = os.path.join(directory, "crypto2.sock")
+            for address in ({}, {"path" : path}):
+                server = await start_server(service, **address)
+                if address:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                else:
+                    host, port = server.sockets[0].getsockname()[:2]
+                    reader, writer = await asyncio.open_connection(host, port)
+                reply = await _request(reader, writer, {"id" : 1, "op" : "public_key"})
+                server_public = reply["result"]
+                message = _hex(b"over the wire")
+                reply = await _request(reader, writer, {"id" : 2, "op" : "sign",
+                                                        "message" : message})
+                assert reply["id"] == 2
+                reply = await _request(reader, writer,
+                                       {"id" : 3, "op" : "verify",
+                                        "public_key" : server_public,
+                                        "message" : message,
+                                        "signature" : reply["result"]})
+                assert reply == {"id" : 3, "result" : True}, reply
+                serialized = _hex(kem.serialize_public_key(kem_public))
+                reply = await _request(reader, writer, {"id" : 4, "op" : "encapsulate",
+                                                        "public_key" : serialized})
+                cryptogram = kem.deserialize_cryptogram(
+                    _unhex(reply["result"]["cryptogram"]))
+                assert (kem.recover_secret(kem_private, cryptogram) ==
+                        int(reply["result"]["secret"], 16))
+                reply = await _request(reader, writer, {"id" : 5, "op" : "unknown"})
+                assert "error" in reply
+                writer.close()
+                server.close()
+                await server.wait_closed()
+            os.remove(path)
+            os.rmdir(directory)
+
+        # requests still waiting for their batch to fill fail on close
+        service = Service(processes=0, max_batch_size=64, max_wait=60)
+        await service.start()
+        pending = [asyncio.ensure_future(service.sign(private, message)) for
+                   message in messages[:3]]
+        await asyncio.sleep(.05)
+        await service.close()
+        results = await asyncio.wait_for(asyncio.gather(*pending,
+                                                        return_exceptions=True), 5)
+        assert all(isinstance(result, RuntimeError) for result in results), results
+        try:
+            await service.sign(private, messages[0])
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("Signed with a closed service")
+
+    asyncio.run(_test())
+    print("aio test complete")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,155 @@
+""" Vector arithmetic over Z_q behind one interface.
+
+    Every backend offers add_vector(v1, v2, q), scale_vector(v, s, q) and
+    dotproduct(v1, v2, q), taking and returning lists of python integers.
+    The dot product is returned reduced mod q.
+
+    - "python": pure python reference
+    - "numpy" : numpy object arrays (requires numpy)
+    - "limb"  : splits residues into 32-bit limbs held in uint64 arrays and
+                accumulates the dot product without reduction, so a single
+                % q covers the whole product (requires numpy)
+
+    The active backend is taken from the CRYPTO2_BACKEND environment variable
+    and defaults to "python", which is the fastest for the default n. Vector
+    addition and scaling, evaluation at G, linearalgebra.Matrix products (and
+    so KEM key generation and encapsulation), signing, cached verification
+    and decryption of uncompressed ciphertexts all go through it. """
+import binascii
+import operator
+import os
+
+import instrumentation
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class PythonBackend(object):
+
+    name = "python"
+
+    def add_vector(self, v1, v2, q):
+        return [(x + y) % q for x, y in zip(v1, v2)]
+
+    def scale_vector(self, v, s, q):
+        return [(x * s) % q for x in v]
+
+    def dotproduct(self, v1, v2, q):
+        return sum(map(operator.mul, v1, v2)) % q
+
+class NumpyBackend(PythonBackend):
+
+    name = "numpy"
+
+    def add_vector(self, v1, v2, q):
+        v1 = numpy.array(v1, dtype=object); v2 = numpy.array(v2, dtype=object)
+        return ((v1 + v2) % q).tolist()
+
+    def scale_vector(self, v, s, q):
+        return ((numpy.array(v, dtype=object) * s) % q).tolist()
+
+    def dotproduct(self, v1, v2, q):
+        v1 = numpy.array(v1, dtype=object); v2 = numpy.array(v2, dtype=object)
+        return int(numpy.dot(v1, v2)) % q
+
+class LimbBackend(NumpyBackend):
+
+    name = "limb"
+    limb_size = 32
+
+    def to_limbs(self, v, limb_count):
+        # (len(v), limb_count) array of big-endian 32-bit limbs
+        template = "%0{}x".format(limb_count * (self.limb_size // 4))
+        data = binascii.unhexlify(''.join(template % x for x in v))
+        limbs = numpy.frombuffer(data, dtype=">u4").astype(numpy.uint64)
+        return limbs.reshape((len(v), limb_count))
+
+    def reduce(self, v, q):
+        # to_limbs needs residues in [0, q); callers may pass anything
+        if v and (min(v) < 0 or max(v) >= q):
+            return [x % q for x in v]
+        return v
+
+    def dotproduct(self, v1, v2, q):
+        limb_size = self.limb_size
+        limb_count = (q.bit_length() + limb_size - 1) // limb_size
+        v1 = self.reduce(v1, q); v2 = self.reduce(v2, q)
+        a = self.to_limbs(v1, limb_count); b = self.to_limbs(v2, limb_count)
+        # limb i of a times limb j of b carries weight 2 ** (32 * (2L - 2 - i - j))
+        # each 64-bit partial product is split in two halves so that summing
+        # len(v) * L of them in a uint64 accumulator cannot overflow
+        mask = numpy.uint64(0xFFFFFFFF); shift = numpy.uint64(limb_size)
+        low = numpy.zeros(2 * limb_count - 1, dtype=numpy.uint64)
+        high = numpy.zeros(2 * limb_count - 1, dtype=numpy.uint64)
+        for i in range(limb_count):
+            products = a[:, i:i + 1] * b
+            low[i:i + limb_count] += (products & mask).sum(axis=0, dtype=numpy.uint64)
+            high[i:i + limb_count] += (products >> shift).sum(axis=0, dtype=numpy.uint64)
+        output = int(high[0])
+        for index in range(2 * limb_count - 1):
+            carry = int(high[index + 1]) if index + 2 < 2 * limb_count else 0
+            output = (output << limb_size) + int(low[index]) + carry
+        return output % q
+
+BACKENDS = {"python" : PythonBackend()}
+if numpy is not None:
+    BACKENDS["numpy"] = NumpyBackend()
+    BACKENDS["limb"] = LimbBackend()
+
+def get_backend(name=None):
+    if name is None:
+        return _active
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError("Backend '{}' is not available".format(name))
+
+def set_backend(name):
+    global _active
+    _active = get_backend(name)
+    return _active
+
+_active = get_backend(os.environ.get("CRYPTO2_BACKEND", "python"))
+
+def add_vector(v1, v2, q):
+    if instrumentation.enabled:
+        instrumentation.count(reductions=len(v1))
+    return _active.add_vector(v1, v2, q)
+
+def scale_vector(v, s, q):
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=len(v), reductions=len(v))
+    return _active.scale_vector(v, s, q)
+
+def dotproduct(v1, v2, q):
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=len(v1), reductions=1)
+    return _active.dotproduct(v1, v2, q)
+
+def test_backends():
+    from utilities import random_integer_mod_q
+    print("Testing vector backends against the python reference...")
+    reference = BACKENDS["python"]
+    for q in (2 ** 61 - 1, (2 ** 256) + 297, (2 ** 512) + 75):
+        size = (q.bit_length() + 7) // 8
+        for n in (1, 23, 257):
+            v1 = [random_integer_mod_q(size, q) for i in range(n)]
+            v2 = [random_integer_mod_q(size, q) for i in range(n)]
+            v1[0] = v2[0] = q - 1
+            s = random_integer_mod_q(size, q)
+            expected = (reference.add_vector(v1, v2, q),
+                        reference.scale_vector(v1, s, q),
+                        reference.dotproduct(v1, v2, q))
+            for name, backend in BACKENDS.items():
+                output = (backend.add_vector(v1, v2, q),
+                          backend.scale_vector(v1, s, q),
+                          backend.dotproduct(v1, v2, q))
+                assert output == expected, (name, q, n)
+            # unreduced input, e.g. a forged signature, must not change the result
+            v1[0] = -1; v2[-1] = v2[-1] + 2 ** (32 * (size + 4))
+            expected = reference.dotproduct(v1, v2, q)
+            for name, backend in BACKENDS.items():
+                assert backend.dotproduct(v1, v2, q) == expected, (name, q, n)
+    print("Backend test complete ({})".format(', '.join(sorted(BACKENDS))))
@@ -0,0 +1,281 @@
+""" Reproducible benchmarks for every public operation and parameter set.
+
+    usage: python benchmark.py run [--iterations N] [--warmup N]
+                                   [--parameter-set NAME ...] [--output FILE]
+                                   [--baseline FILE] [--threshold FRACTION]
+           python benchmark.py compare BASELINE CURRENT [--threshold FRACTION]
+
+    Each operation is timed call by call after a warm-up, with the garbage
+    collector disabled. Results report the median, 90th and 99th percentile
+    latency in seconds plus operations per second (from the median), and can
+    be written as JSON. compare exits with status 1 when the median of any
+    operation in CURRENT exceeds the BASELINE median by more than threshold. """
+import argparse
+import gc
+import json
+import platform
+import sys
+from timeit import default_timer
+
+import backend
+import ciphertextbatch
+import encryption
+import kem
+import signature
+from parameters import PARAMETER_SETS, get_parameters
+from utilities import random_integer_mod_q
+
+def _encryption_setup(parameters):
+    key = encryption.generate_secret_key(parameters)
+    q, n = parameters['q'], parameters['n']
+    ciphertext = encryption.encrypt(key, 1, parameters)
+    ciphertext2 = encryption.encrypt(key, 2, parameters)
+    uncompressed = (encryption.decompress(ciphertext[0], q, n), ciphertext[1])
+    scalar = random_integer_mod_q(parameters["r_size"], q)
+    return key, ciphertext, ciphertext2, uncompressed, scalar
+
+def _bench_encryption_keygen(parameters):
+    return lambda: encryption.generate_secret_key(parameters)
+
+def _bench_encrypt(parameters):
+    key = _encryption_setup(parameters)[0]
+    return lambda: encryption.encrypt(key, 1, parameters)
+
+def _bench_decrypt(parameters):
+    key, ciphertext, ciphertext2, uncompressed, scalar = _encryption_setup(parameters)
+    return lambda: encryption.decrypt(key, uncompressed, parameters)
+
+def _bench_add(parameters):
+    # dense operands: adding fresh ciphertexts only appends to a lazy SeedSum
+    key, ciphertext, ciphertext2, uncompressed, scalar = _encryption_setup(parameters)
+    uncompressed2 = encryption.densify(ciphertext2, parameters)
+    return lambda: encryption.add_ciphertexts(uncompressed, uncompressed2,
+                                              parameters)
+
+def _bench_scale(parameters):
+    key, ciphertext, ciphertext2, uncompressed, scalar = _encryption_setup(parameters)
+    return lambda: encryption.scale_ciphertext(ciphertext, scalar, parameters)
+
+# ciphertexts per call in the batch benchmarks; batch.* times a
+# CiphertextBatch with decoded columns, batch.*_tuples the same work as a loop
+# over (seed, scalar) tuples
+BATCH_SIZE = 256
+
+def _dense_ciphertexts(parameters):
+    key = encryption.generate_secret_key(parameters)
+    return [encryption.densify(ciphertext, parameters) for ciphertext in
+            encryption.encrypt_many(key, [1] * BATCH_SIZE, parameters)]
+
+def _dense_batch(parameters):
+    batch = ciphertextbatch.from_ciphertexts(_dense_ciphertexts(parameters),
+                                             parameters)
+    batch.values()
+    return batch
+
+def _bench_batch_add(parameters):
+    batch = _dense_batch(parameters)
+    return lambda: batch.add(batch)
+
+def _bench_batch_add_tuples(parameters):
+    ciphertexts = _dense_ciphertexts(parameters)
+    add = encryption.add_scaled_ciphertexts
+    return lambda: [add(ciphertext, ciphertext, parameters) for ciphertext in
+                    ciphertexts]
+
+def _bench_batch_scale(parameters):
+    batch = _dense_batch(parameters)
+    scalar = random_integer_mod_q(parameters["r_size"], parameters['q'])
+    return lambda: batch.scale(scalar)
+
+def _bench_batch_scale_tuples(parameters):
+    ciphertexts = _dense_ciphertexts(parameters)
+    scalar = random_integer_mod_q(parameters["r_size"], parameters['q'])
+    scale = encryption.scale_ciphertext
+    return lambda: [scale(ciphertext, scalar, parameters) for ciphertext in
+                    ciphertexts]
+
+def _bench_kem_keygen(parameters):
+    return lambda: kem.generate_keypair(parameters)
+
+def _bench_encapsulate(parameters):
+    public_key, private_key = kem.generate_keypair(parameters)
+    return lambda: kem.encapsulate_secret(public_key, parameters)
+
+def _bench_recover(parameters):
+    public_key, private_key = kem.generate_keypair(parameters)
+    secret, cryptogram = kem.encapsulate_secret(public_key, parameters)
+    return lambda: kem.recover_secret(private_key, cryptogram, parameters)
+
+def _bench_signature_keygen(parameters):
+    return lambda: signature.generate_keypair(parameters)
+
+def _bench_sign(parameters):
+    public_key, private_key = signature.generate_keypair(parameters)
+    return lambda: signature.sign(private_key, "benchmark", parameters)
+
+def _bench_verify(parameters):
+    public_key, private_key = signature.generate_keypair(parameters)
+    signed = signature.sign(private_key, "benchmark", parameters)
+    def _verify():
+        # a cold verification: the challenge is not in the shared cache
+        signature.challenge_cache.clear()
+        return signature.verify(public_key, "benchmark", signed, parameters)
+    return _verify
+
+BENCHMARKS = (("encryption.keygen", _bench_encryption_keygen),
+              ("encryption.encrypt", _bench_encrypt),
+              ("encryption.decrypt", _bench_decrypt),
+              ("encryption.add", _bench_add),
+              ("encryption.scale", _bench_scale),
+              ("batch.add", _bench_batch_add),
+              ("batch.add_tuples", _bench_batch_add_tuples),
+              ("batch.scale", _bench_batch_scale),
+              ("batch.scale_tuples", _bench_batch_scale_tuples),
+              ("kem.keygen", _bench_kem_keygen),
+              ("kem.encapsulate", _bench_encapsulate),
+              ("kem.recover", _bench_recover),
+              ("signature.keygen", _bench_signature_keygen),
+              ("signature.sign", _bench_sign),
+              ("signature.verify", _bench_verify))
+
+def percentile(sorted_samples, fraction):
+    # nearest-rank percentile of an already sorted list
+    index = int(round(fraction * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+def summarize(samples):
+    samples = sorted(samples)
+    median = percentile(samples, .5)
+    return {"iterations" : len(samples), "min" : samples[0],
+            "median" : median, "p90" : percentile(samples, .9),
+            "p99" : percentile(samples, .99),
+            "mean" : sum(samples) / len(samples),
+            "ops_per_second" : (1 / median) if median else float("inf")}
+
+def time_operation(operation, iterations, warmup):
+    for count in range(warmup):
+        operation()
+    samples = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for count in range(iterations):
+            before = default_timer()
+            operation()
+            samples.append(default_timer() - before)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return summarize(samples)
+
+def run(parameter_sets=None, iterations=256, warmup=16, operations=None,
+        stream=None):
+    """ usage: run(parameter_sets=None, iterations=256, warmup=16,
+                   operations=None, stream=None) => results
+
+        Benchmarks every operation (or those named in operations) for every
+        parameter set (or those named in parameter_sets). """
+    if parameter_sets is None:
+        parameter_sets = sorted(PARAMETER_SETS)
+    results = {}
+    for name in parameter_sets:
+        parameters = get_parameters(name)
+        results[name] = {}
+        for operation_name, factory in BENCHMARKS:
+            if operations is not None and operation_name not in operations:
+                continue
+            summary = time_operation(factory(parameters), iterations, warmup)
+            results[name][operation_name] = summary
+            if stream is not None:
+                stream.write("{:<12} {:<20} median {:.6f}s p90 {:.6f}s "
+                             "p99 {:.6f}s {:>10.1f} ops/s\n".format(
+                             name, operation_name, summary["median"],
+                             summary["p90"], summary["p99"],
+                             summary["ops_per_second"]))
+    metadata = {"python" : platform.python_version(),
+                "implementation" : platform.python_implementation(),
+                "platform" : platform.platform(),
+                "backend" : backend.get_backend().name,
+                "iterations" : iterations, "warmup" : warmup}
+    return {"metadata" : metadata, "results" : results}
+
+def compare(baseline, current, threshold=.1):
+    """ usage: compare(baseline, current, threshold=.1) => regressions
+
+        Returns (parameter_set, operation, baseline_median, current_median)
+        for every operation whose median grew by more than threshold. """
+    regressions = []
+    for name, operations in sorted(current["results"].items()):
+        for operation_name, summary in sorted(operations.items()):
+            try:
+                old = baseline["results"][name][operation_name]["median"]
+            except KeyError:
+                continue
+            if summary["median"] > old * (1 + threshold):
+                regressions.append((name, operation_name, old, summary["median"]))
+    return regressions
+
+def _report_regressions(regressions, threshold):
+    for name, operation_name, old, new in regressions:
+        print("REGRESSION {} {}: median {:.6f}s -> {:.6f}s (+{:.1f}%, threshold "
+              "{:.1f}%)".format(name, operation_name, old, new,
+                                100 * ((new / old) - 1), 100 * threshold))
+    return 1 if regressions else 0
+
+def _load(filename):
+    with open(filename, 'r') as _file:
+        return json.load(_file)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="crypto2 benchmarks")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--iterations", type=int, default=256)
+    run_parser.add_argument("--warmup", type=int, default=16)
+    run_parser.add_argument("--parameter-set", action="append",
+                            choices=sorted(PARAMETER_SETS))
+    run_parser.add_argument("--operation", action="append",
+                            choices=[name for name, factory in BENCHMARKS])
+    run_parser.add_argument("--output")
+    run_parser.add_argument("--baseline")
+    run_parser.add_argument("--threshold", type=float, default=.1)
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=.1)
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == "compare":
+        regressions = compare(_load(arguments.baseline),
+                              _load(arguments.current), arguments.threshold)
+        return _report_regressions(regressions, arguments.threshold)
+
+    results = run(arguments.parameter_set, arguments.iterations,
+                  arguments.warmup, arguments.operation, sys.stdout)
+    if arguments.output:
+        with open(arguments.output, 'w') as _file:
+            json.dump(results, _file, indent=4, sort_keys=True)
+    if arguments.baseline:
+        regressions = compare(_load(arguments.baseline), results,
+                              arguments.threshold)
+        return _report_regressions(regressions, arguments.threshold)
+    return 0
+
+def test_benchmark():
+    print("Testing benchmark.py...")
+    results = run(["crypto2-128"], iterations=4, warmup=1,
+                  operations=("encryption.encrypt", "signature.verify",
+                              "batch.add", "batch.add_tuples"))
+    summary = results["results"]["crypto2-128"]["encryption.encrypt"]
+    assert summary["iterations"] == 4
+    assert summary["min"] <= summary["median"] <= summary["p90"] <= summary["p99"]
+    slower = json.loads(json.dumps(results))
+    slower["results"]["crypto2-128"]["signature.verify"]["median"] *= 2
+    assert compare(results, results) == []
+    assert [entry[:2] for entry in compare(results, slower)] == \
+           [("crypto2-128", "signature.verify")]
+    print("Benchmark test complete")
+
+if __name__ == "__main__":
+    sys.exit(main())
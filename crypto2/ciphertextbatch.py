@@ -0,0 +1,442 @@
+""" Columnar storage for large collections of ciphertexts.
+
+    A CiphertextBatch keeps the seeds and the scalars of its ciphertexts as
+    two columns. The seeds are either all compressed (one element per
+    ciphertext) or all uncompressed (n elements per ciphertext). Each
+    column exists in up to two forms, converted lazily:
+
+    - packed: contiguous fixed-width big-endian elements, the encoding of
+      serialization.pack_elements. This is the form that is saved, mapped
+      from a file and sliced without copies.
+    - values: a flat list of python integers. A packed batch is only decoded
+      and cached by an explicit batch.values() call.
+
+    add, scale, densify, decrypt and total work on about BLOCK_SIZE seed
+    elements at a time and decode a packed-only batch block by block without caching, so
+    a mapped batch is processed in bounded memory. The result of add, scale
+    and densify holds values when every operand does, so a chain of bulk
+    operations on decoded batches never re-encodes; otherwise it is packed
+    block by block. compact() packs a batch and drops its values, which
+    keeps only the packed bytes in memory (about 2.3x smaller than tuples
+    when uncompressed).
+
+    Conversion to and from the (seed, scalar) tuples of encryption.py is
+    explicit: from_ciphertexts, batch.ciphertext(index) and
+    batch.to_ciphertexts().
+
+    File layout: header | seeds column | scalars column """
+import operator
+import struct
+
+import core
+import encryption
+import serialization
+from keystore import parameters_fingerprint
+from parameters import PARAMETERS
+from utilities import map_file, unmap_file
+
+VERSION = 1
+MAGIC = b"C2CB"
+BLOCK_SIZE = 4096
+
+# magic, version, seed width, element size, number of ciphertexts,
+# parameters fingerprint
+_HEADER = struct.Struct(">4sBHHQ16s")
+
+class CiphertextBatch(object):
+    """ usage: CiphertextBatch(seeds, scalars, width, parameters=PARAMETERS,
+                               source=None, packed=True) => batch
+
+        With packed=True, seeds and scalars are buffers of packed elements;
+        otherwise they are flat lists of integers mod q. width is 1 for
+        compressed seeds and n for uncompressed ones. source is kept alive
+        with the batch (the mapping of a loaded file). """
+
+    __slots__ = ("_seeds", "_scalars", "_seed_values", "_scalar_values",
+                 "width", "size", "parameters", "source")
+
+    def __init__(self, seeds, scalars, width, parameters=PARAMETERS,
+                 source=None, packed=True):
+        size = serialization.element_size(parameters['q'])
+        if width not in (1, parameters['n']):
+            raise ValueError("Seed width must be 1 or {}".format(parameters['n']))
+        if packed:
+            seeds = memoryview(seeds); scalars = memoryview(scalars)
+            if len(scalars) % size or len(seeds) != len(scalars) * width:
+                raise ValueError("Seed and scalar columns do not match")
+            self._seeds, self._scalars = seeds, scalars
+            self._seed_values = self._scalar_values = None
+        else:
+            if len(seeds) != len(scalars) * width:
+                raise ValueError("Seed and scalar columns do not match")
+            self._seeds = self._scalars = None
+            self._seed_values, self._scalar_values = seeds, scalars
+        self.width = width
+        self.size = size
+        self.parameters = parameters
+        self.source = source
+
+    @property
+    def compressed(self):
+        return self.width == 1
+
+    @property
+    def packed(self):
+        return self._seeds is not None
+
+    @property
+    def decoded(self):
+        return self._seed_values is not None
+
+    def __len__(self):
+        if self._scalar_values is not None:
+            return len(self._scalar_values)
+        return len(self._scalars) // self.size
+
+    @property
+    def seeds(self):
+        # the packed seed column, encoded on first use
+        if self._seeds is None:
+            self._seeds = memoryview(serialization.pack_elements(
+                                     self._seed_values, self.parameters['q']))
+        return self._seeds
+
+    @property
+    def scalars(self):
+        if self._scalars is None:
+            self._scalars = memoryview(serialization.pack_elements(
+                                       self._scalar_values, self.parameters['q']))
+        return self._scalars
+
+    def values(self):
+        """ usage: batch.values() => (flat seed elements, scalars)
+
+            The decoded columns, cached on the batch. Treat as read-only. """
+        if self._seed_values is None:
+            q = self.parameters['q']
+            self._seed_values = serialization.unpack_elements(self._seeds, q)
+            self._scalar_values = serialization.unpack_elements(self._scalars, q)
+        return self._seed_values, self._scalar_values
+
+    def compact(self):
+        # pack the columns and drop the decoded values
+        self.seeds; self.scalars
+        self._seed_values = self._scalar_values = None
+        return self
+
+    def __getitem__(self, index):
+        # slices share packed columns; single ciphertexts are converted explicitly
+        if not isinstance(index, slice):
+            raise TypeError("Use batch.ciphertext(index) for a single ciphertext")
+        start, stop, step = index.indices(len(self))
+        if step != 1:
+            raise ValueError("Only contiguous slices are supported")
+        stop = max(start, stop)
+        width, size = self.width, self.size
+        if self.decoded:
+            # the lists are sliced; the integers themselves are shared
+            return CiphertextBatch(self._seed_values[start * width:stop * width],
+                                   self._scalar_values[start:stop], width,
+                                   self.parameters, packed=False)
+        row = width * size
+        return CiphertextBatch(self._seeds[start * row:stop * row],
+                               self._scalars[start * size:stop * size],
+                               width, self.parameters, self.source)
+
+    def blocks(self, block_size=None):
+        """ usage: batch.blocks(block_size=None) => iterator
+
+            (flat seed elements, scalars) for block_size ciphertexts at a
+            time, by default as many as hold BLOCK_SIZE seed elements; a
+            packed-only batch is decoded block by block, uncached. """
+        width = self.width
+        block_size = block_size or max(1, BLOCK_SIZE // width)
+        for start in range(0, len(self), block_size):
+            stop = min(start + block_size, len(self))
+            if self.decoded:
+                yield (self._seed_values[start * width:stop * width],
+                       self._scalar_values[start:stop])
+            else:
+                part = self[start:stop]
+                q = self.parameters['q']
+                yield (serialization.unpack_elements(part._seeds, q),
+                       serialization.unpack_elements(part._scalars, q))
+
+    def ciphertext(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Batch index out of range")
+        seeds, scalars = next(self[index:index + 1].blocks())
+        return (seeds[0] if self.compressed else seeds), scalars[0]
+
+    def to_ciphertexts(self):
+        output = []
+        width = self.width
+        for seeds, scalars in self.blocks():
+            if self.compressed:
+                output.extend(zip(seeds, scalars))
+            else:
+                output.extend((seeds[index * width:(index + 1) * width], scalar)
+                              for index, scalar in enumerate(scalars))
+        return output
+
+    def _check(self, other):
+        if len(self) != len(other):
+            raise ValueError("Batches differ in length: {} != {}".format(
+                             len(self), len(other)))
+        if ((self.parameters['q'], self.parameters['n']) !=
+            (other.parameters['q'], other.parameters['n'])):
+            raise ValueError("Batches use different parameters")
+
+    def _dense_blocks(self):
+        # blocks() with each compressed seed decompressed to n elements; the
+        # block size depends only on n, so blocks of two batches line up
+        q, n = self.parameters['q'], self.parameters['n']
+        powers = core.powers
+        for seeds, scalars in self.blocks(max(1, BLOCK_SIZE // n)):
+            if self.compressed:
+                seeds = [x for seed in seeds for x in powers(seed, q, n)]
+            yield seeds, scalars
+
+    def _batch(self, blocks, decoded):
+        # an uncompressed batch from (seeds, scalars) blocks: values when
+        # decoded, otherwise each block is packed as it arrives
+        q, n = self.parameters['q'], self.parameters['n']
+        if decoded:
+            seeds, scalars = [], []
+            for block_seeds, block_scalars in blocks:
+                seeds.extend(block_seeds)
+                scalars.extend(block_scalars)
+            return CiphertextBatch(seeds, scalars, n, self.parameters,
+                                   packed=False)
+        seeds, scalars = bytearray(), bytearray()
+        pack = serialization.pack_elements
+        for block_seeds, block_scalars in blocks:
+            seeds += pack(block_seeds, q)
+            scalars += pack(block_scalars, q)
+        return CiphertextBatch(seeds, scalars, n, self.parameters)
+
+    def densify(self):
+        # the batch with uncompressed seeds; each seed is decompressed once
+        if not self.compressed:
+            return self
+        return self._batch(self._dense_blocks(), self.decoded)
+
+    def add(self, other):
+        """ usage: batch.add(other) => CiphertextBatch
+
+            The elementwise sum of two batches of the same length. The
+            output is uncompressed; each block of a column is added as one
+            flat vector. """
+        self._check(other)
+        q = self.parameters['q']
+        add = core.add_vector
+        return self._batch(((add(seeds1, seeds2, q), add(scalars1, scalars2, q))
+                            for (seeds1, scalars1), (seeds2, scalars2) in
+                            zip(self._dense_blocks(), other._dense_blocks())),
+                           self.decoded and other.decoded)
+
+    def scale(self, scalar):
+        """ usage: batch.scale(scalar) => CiphertextBatch
+
+            Every ciphertext multiplied by scalar. Compressed seeds are
+            decompressed and scaled in the same pass. """
+        q, n = self.parameters['q'], self.parameters['n']
+        powers, scale = core.powers, core.scale_vector
+        def scaled(seeds):
+            if self.compressed:
+                return [x for seed in seeds for x in powers(seed, q, n, scalar)]
+            return scale(seeds, scalar, q)
+        return self._batch(((scaled(seeds), scale(scalars, scalar, q)) for
+                            seeds, scalars in self.blocks(max(1, BLOCK_SIZE // n))),
+                           self.decoded)
+
+    def total(self):
+        """ usage: batch.total() => ciphertext
+
+            The sum of every ciphertext in the batch as an uncompressed
+            (seed, scalar) tuple. Each coordinate is summed unreduced and
+            reduced once. """
+        q, n = self.parameters['q'], self.parameters['n']
+        seed = [0] * n
+        scalar = 0
+        for seeds, scalars in self.blocks():
+            if self.compressed:
+                sums = core.sum_of_powers(seeds, q, n)
+            else:
+                sums = [sum(seeds[j::n]) for j in range(n)]
+            seed = list(map(operator.add, seed, sums))
+            scalar += sum(scalars)
+        return [x % q for x in seed], scalar % q
+
+    def decrypt(self, key):
+        """ usage: batch.decrypt(key) => [m, ...]
+
+            Compressed seeds share one batch of power sums per block;
+            uncompressed seeds take one dot product each against the
+            powers of the PRF key, built once. """
+        k, prf_key = key
+        q, n = self.parameters['q'], self.parameters['n']
+        output = []
+        if self.compressed:
+            for seeds, scalars in self.blocks():
+                random_scalars = core.f_many(prf_key, seeds, q, n)
+                output.extend((scalar - (k * random_scalar)) % q for
+                              scalar, random_scalar in zip(scalars, random_scalars))
+        else:
+            powers = encryption.prepare_secret_key(key, self.parameters).powers
+            mul = operator.mul
+            for seeds, scalars in self.blocks():
+                output.extend((scalar - (k * sum(map(mul, seeds[index * n:
+                                                                 (index + 1) * n],
+                                                          powers)))) % q for
+                              index, scalar in enumerate(scalars))
+        return output
+
+def from_ciphertexts(ciphertexts, parameters=PARAMETERS):
+    """ usage: from_ciphertexts(ciphertexts, parameters=PARAMETERS) => CiphertextBatch
+
+        The batch stays compressed when every ciphertext is fresh; otherwise
+        every ciphertext is stored uncompressed (SeedSums are densified).
+        The batch holds values; compact() packs it. """
+    ciphertexts = list(ciphertexts)
+    scalars = [scalar for seed, scalar in ciphertexts]
+    if all(not isinstance(seed, (list, tuple, encryption.SeedSum)) for
+           seed, scalar in ciphertexts):
+        return CiphertextBatch([seed for seed, scalar in ciphertexts], scalars,
+                               1, parameters, packed=False)
+    densify = encryption.densify
+    seeds = [element for ciphertext in ciphertexts for element in
+             densify(ciphertext, parameters)[0]]
+    return CiphertextBatch(seeds, scalars, parameters['n'], parameters,
+                           packed=False)
+
+def save_batch(batch, path):
+    header = _HEADER.pack(MAGIC, VERSION, batch.width, batch.size, len(batch),
+                          parameters_fingerprint(batch.parameters))
+    with open(path, "wb") as _file:
+        _file.write(header)
+        _file.write(batch.seeds)
+        _file.write(batch.scalars)
+
+def load_batch(path, parameters=PARAMETERS):
+    """ usage: load_batch(path, parameters=PARAMETERS) => CiphertextBatch
+
+        Maps a file written by save_batch read-only; the columns are views
+        of the mapping and elements are decoded only when used. """
+    mapped, view = map_file(path)
+    try:
+        if len(view) < _HEADER.size:
+            raise ValueError("Truncated ciphertext batch")
+        magic, version, width, size, count, fingerprint = _HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a ciphertext batch: {}".format(path))
+        if (fingerprint != parameters_fingerprint(parameters) or
+            size != serialization.element_size(parameters['q'])):
+            raise ValueError("Ciphertext batch was written for other parameters")
+        middle = _HEADER.size + (count * width * size)
+        if len(view) != middle + (count * size):
+            raise ValueError("Invalid length {} for {} ciphertexts".format(
+                             len(view), count))
+        return CiphertextBatch(view[_HEADER.size:middle], view[middle:], width,
+                               parameters, mapped)
+    except ValueError:
+        unmap_file(mapped, view)
+        raise
+
+def test_ciphertext_batch():
+    import os
+    import tempfile
+    from utilities import random_integer_mod_q
+    print("Testing ciphertextbatch.py...")
+    q, n = PARAMETERS['q'], PARAMETERS['n']
+    key = encryption.generate_secret_key()
+    messages = list(range(10))
+    fresh = encryption.encrypt_many(key, messages)
+    batch = from_ciphertexts(fresh)
+    assert batch.compressed and len(batch) == 10 and not batch.packed
+    assert len(batch.seeds) == 10 * batch.size and batch.packed
+    packed = CiphertextBatch(batch.seeds, batch.scalars, 1)
+    assert packed.to_ciphertexts() == fresh and packed._seed_values is None
+    assert packed[2:5].decrypt(key) == messages[2:5]
+    assert packed.values() == batch.values()
+    assert packed.compact()._seed_values is None
+    assert batch.to_ciphertexts() == fresh
+    assert batch.ciphertext(-1) == fresh[-1]
+    assert batch.decrypt(key) == messages
+    assert batch[2:5].to_ciphertexts() == fresh[2:5]
+
+    mixed = [encryption.add_ciphertexts(fresh[0], fresh[1]),
+             encryption.scale_ciphertext(fresh[2], 3)] + fresh[3:]
+    dense = from_ciphertexts(mixed)
+    assert not dense.compressed and len(dense.seeds) == 9 * n * dense.size
+    assert dense.decrypt(key) == [1, 6] + messages[3:]
+    assert dense.ciphertext(1) == mixed[1]
+
+    scalar = random_integer_mod_q(PARAMETERS["r_size"], q)
+    expected = [(m * scalar) % q for m in messages]
+    assert batch.scale(scalar).decrypt(key) == expected
+    assert dense.densify() is dense
+    assert batch.densify().decrypt(key) == messages
+    doubled = batch.add(batch.densify())
+    assert not doubled.packed
+    assert doubled.decrypt(key) == [(2 * m) % q for m in messages]
+    assert doubled.compact().decrypt(key) == [(2 * m) % q for m in messages]
+    # packed-only operands are streamed and never decoded into the cache
+    doubled = packed.add(packed)
+    assert doubled.packed and not doubled.decoded and not packed.decoded
+    assert doubled.decrypt(key) == [(2 * m) % q for m in messages]
+    assert packed.scale(scalar).decrypt(key) == expected and not packed.decoded
+    assert packed.densify().packed and not packed.decoded
+    global BLOCK_SIZE
+    block_size, BLOCK_SIZE = BLOCK_SIZE, 2 * n + 1
+    try:
+        # several blocks, compressed and uncompressed operands
+        assert len(list(packed.blocks())) == 1
+        assert len(list(packed.densify().blocks())) == 5
+        assert (packed.add(batch.densify().compact()).decrypt(key) ==
+                [(2 * m) % q for m in messages])
+    finally:
+        BLOCK_SIZE = block_size
+    assert doubled[3:5].to_ciphertexts() == doubled.to_ciphertexts()[3:5]
+    total = sum(messages) % q
+    assert encryption.decrypt(key, batch.total()) == total
+    assert encryption.decrypt(key, batch.densify().total()) == total
+    for bad in (batch[:3], ):
+        try:
+            batch.add(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Added batches of different lengths")
+    try:
+        batch[::2]
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Took a strided slice")
+
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        for stored in (batch, dense):
+            save_batch(stored, path)
+            loaded = load_batch(path)
+            assert loaded.width == stored.width
+            assert loaded.to_ciphertexts() == stored.to_ciphertexts()
+            assert loaded[1:3].decrypt(key) == stored[1:3].decrypt(key)
+            assert loaded.add(stored).decrypt(key) == stored.add(stored).decrypt(key)
+            assert not loaded.decoded
+            del loaded
+        with open(path, "ab") as _file:
+            _file.write(b"\x00")
+        try:
+            load_batch(path)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Loaded a batch of invalid length")
+    finally:
+        os.remove(path)
+    print("Ciphertext batch test complete")
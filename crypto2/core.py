@@ -1,19 +1,114 @@
+import backend
+import instrumentation
+
+# a single closed-form power sum costs one inversion, which is slower than the
+# naive loop for small n; batches amortize the inversion via Montgomery's trick
+CLOSED_FORM_THRESHOLD = 96
+
 def dotproduct(v1, v2):
     return sum(v1[i] * v2i for i, v2i in enumerate(v2))
 
 def scale_vector(v, s, q):
-    return [(x * s) % q for x in v]
+    return backend.scale_vector(v, s, q)
 
 def add_vector(v1, v2, q):
-    #print v1
-    #print [(i, scalar) for i, scalar in enumerate(v2)]
-    #for i, scalar in enumerate(v2):
-    #    print i, scalar
-    #    yield (v1[i] + scalar) % q
-    return [(v1[i] + v2i) % q for i, v2i in enumerate(v2)]
+    return backend.add_vector(v1, v2, q)
+
+def powers(x, q, n, scale=1):
+    # [scale * x, scale * x^2, ..., scale * x^n] mod q; one multiply per entry
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=n + 1, reductions=n + 1)
+    output = []
+    temp = (scale * x) % q
+    for i in range(n):
+        output.append(temp)
+        temp = (temp * x) % q
+    return output
+
+def sum_of_powers(xs, q, n):
+    # [sum(x^j for x in xs) mod q for j in range(1, n + 1)], one column at a time
+    xs = [x % q for x in xs]
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=(n - 1) * len(xs),
+                              reductions=(n * len(xs)) + n)
+    output = []
+    column = xs
+    for j in range(n):
+        output.append(sum(column) % q)
+        if j + 1 < n:
+            column = [(x * y) % q for x, y in zip(column, xs)]
+    return output
+
+def inverse(x, q):
+    # extended euclidean algorithm; cheaper than pow(x, q - 2, q) in python
+    if instrumentation.enabled:
+        instrumentation.count(inversions=1)
+    x0, x1, r0, r1 = 1, 0, x % q, q
+    while r1:
+        quotient = r0 // r1
+        r0, r1 = r1, r0 - (quotient * r1)
+        x0, x1 = x1, x0 - (quotient * x1)
+    if r0 != 1:
+        raise ValueError("{} is not invertible mod {}".format(x, q))
+    return x0 % q
+
+def batch_inverse(values, q):
+    # Montgomery's trick: 3(m - 1) multiplications and 1 inversion for m values
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=3 * len(values),
+                              reductions=3 * len(values))
+    prefix = []
+    accumulator = 1
+    for value in values:
+        prefix.append(accumulator)
+        accumulator = (accumulator * value) % q
+    accumulator = inverse(accumulator, q)
+    output = [0] * len(prefix)
+    for index in range(len(prefix) - 1, -1, -1):
+        output[index] = (accumulator * prefix[index]) % q
+        accumulator = (accumulator * values[index]) % q
+    return output
+
+def _power_sum_loop(k, q, n):
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=n - 1, reductions=2 * (n - 1))
+    output = accumulator = k
+    for exponent in range(2, n + 1):
+        accumulator = (accumulator * k) % q
+        output = (output + accumulator) % q
+    return output
+
+def power_sum(k, q, n):
+    # k + k^2 + ... + k^n mod q
+    k %= q
+    if k == 1:
+        return n % q
+    if n < CLOSED_FORM_THRESHOLD:
+        return _power_sum_loop(k, q, n)
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=2, reductions=1, pow=1)
+    return (k * (pow(k, n, q) - 1) * inverse(k - 1, q)) % q
+
+def power_sums(ks, q, n):
+    # [power_sum(k, q, n) for k in ks], sharing a single inversion
+    ks = [k % q for k in ks]
+    indices = [index for index, k in enumerate(ks) if k != 1]
+    if n * len(indices) < CLOSED_FORM_THRESHOLD:
+        return [power_sum(k, q, n) for k in ks]
+    inverses = batch_inverse([ks[index] - 1 for index in indices], q)
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=2 * len(indices),
+                              reductions=len(indices), pow=len(indices))
+    output = [n % q] * len(ks)
+    for index, k_inverse in zip(indices, inverses):
+        k = ks[index]
+        output[index] = (k * (pow(k, n, q) - 1) * k_inverse) % q
+    return output
 
 def decompress_and_add(x, y, q, n):
     # [(pow(x, i, q) + pow(y, i, q)) % q for i in range(1, n + 1)]
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=2 * n, reductions=3 * n)
     output = []
     xtemp = x; ytemp = y
     for i in range(1, n + 1):
@@ -24,8 +119,29 @@ def decompress_and_add(x, y, q, n):
 
 def f(x, y, q, n):
     # decompress two scalars `x, y` into vectors `X, Y` and output `X . Y mod q`
-    output = accumulator = k = (x * y) % q  # exponent = 1   output = xy
-    for exponent in range(2, n + 1):
-        accumulator = (accumulator * k) % q
-        output = (output + accumulator) % q
-    return output
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=1, reductions=1)
+    return power_sum((x * y) % q, q, n)
+
+def f_many(x, ys, q, n):
+    # [f(x, y, q, n) for y in ys]
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=len(ys), reductions=len(ys))
+    return power_sums([(x * y) % q for y in ys], q, n)
+
+def test_power_sums():
+    from utilities import random_integer_mod_q
+    print("Testing power sums...")
+    q = 2 ** 127 - 1
+    for n in (1, 2, 23, CLOSED_FORM_THRESHOLD, 2 * CLOSED_FORM_THRESHOLD):
+        ks = [0, 1, q - 1, q + 1] + [random_integer_mod_q(32, q) for i in range(16)]
+        expected = [sum(pow(k, i, q) for i in range(1, n + 1)) % q for k in ks]
+        assert [power_sum(k, q, n) for k in ks] == expected, n
+        assert power_sums(ks, q, n) == expected, n
+        assert powers(ks[-1], q, n) == [pow(ks[-1], i, q) for i in range(1, n + 1)]
+        assert sum_of_powers(ks, q, n) == [sum(pow(k, i, q) for k in ks) % q for
+                                           i in range(1, n + 1)]
+    values = [random_integer_mod_q(32, q) or 1 for i in range(16)]
+    assert all((value * inverse(value, q)) % q == 1 for value in values)
+    assert batch_inverse(values, q) == [inverse(value, q) for value in values]
+    print("Power sum test complete")
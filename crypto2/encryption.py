@@ -1,32 +1,86 @@
-import ast
-
 from parameters import *
-from utilities import random_integer_mod_q
+from utilities import random_integer_mod_q, random_vector_mod_q
+import backend
 import core
+import instrumentation
+import serialization
 
-def f(X, y, q, n):
-    # operates on uncompressed vector X and compressed scalar y
-    output = 0
-    ytemp = y
-    assert isinstance(X, list), type(X)
-    for i, scalar in enumerate(X):
-        output = (output + (ytemp * scalar)) % q
-        ytemp = (ytemp * y) % q
-    return output
+class SeedSum(object):
+    """ The seed of a sum of fresh ciphertexts, kept as the list of compressed
+        seeds instead of the sum of their decompressed vectors. """
+
+    __slots__ = ("seeds", )
+
+    def __init__(self, seeds):
+        self.seeds = tuple(seeds)
+
+    def __len__(self):
+        return len(self.seeds)
+
+    def __eq__(self, other):
+        return isinstance(other, SeedSum) and self.seeds == other.seeds
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "SeedSum({})".format(list(self.seeds))
+
+def _compressed_seeds(seed):
+    # the seeds of a compressed or lazy ciphertext; None for an uncompressed one
+    if isinstance(seed, SeedSum):
+        return seed.seeds
+    elif isinstance(seed, list) or isinstance(seed, tuple):
+        return None
+    return (seed, )
 
 def decompress(x, q, n):
-    return [pow(x, i, q) for i in range(1, n + 1)]
+    return core.powers(x, q, n)
     #xtemp = 1
     #for i in range(1, n + 1):
     #    xtemp = (xtemp * x) % q
     #    yield xtemp
 
+class PreparedSecretKey(object):
+    """ A secret key with the powers of its PRF key decompressed once.
+
+        Unpacks like the (k, prf_key) tuple, so it can be used wherever a key
+        is expected; uncompressed ciphertexts then decrypt with a single dot
+        product instead of rebuilding the powers. """
+
+    __slots__ = ("k", "prf_key", "powers", "parameters")
+
+    def __init__(self, key, parameters=PARAMETERS):
+        self.k, self.prf_key = key
+        self.powers = tuple(core.powers(self.prf_key, parameters['q'],
+                                        parameters['n']))
+        self.parameters = parameters
+
+    def __iter__(self):
+        return iter((self.k, self.prf_key))
+
+    def __len__(self):
+        return 2
+
+    def random_scalar(self, vector):
+        # X . (prf_key, prf_key^2, ...) mod q, reduced once
+        if len(vector) != len(self.powers):
+            raise ValueError("Expected an uncompressed ciphertext of {} "
+                             "entries, got {}".format(len(self.powers), len(vector)))
+        return backend.dotproduct(vector, self.powers, self.parameters['q'])
+
+def prepare_secret_key(key, parameters=PARAMETERS):
+    if isinstance(key, PreparedSecretKey):
+        return key
+    return PreparedSecretKey(key, parameters)
+
+@instrumentation.operation("encryption.keygen")
 def generate_secret_key(parameters=PARAMETERS):
     r_size, q, n = parameters["r_size"], parameters['q'], parameters['n']
-    prf_key = random_integer_mod_q(r_size, q)#compressible_vector(r_size, n, q)
-    k = random_integer_mod_q(r_size, q)
+    prf_key, k = random_vector_mod_q(r_size, q, 2)#compressible_vector(r_size, n, q)
     return k, prf_key
 
+@instrumentation.operation("encryption.encrypt")
 def encrypt(key, m, parameters=PARAMETERS):
     # (k * f(x)) + m mod q
     n, q, r_size = parameters['n'], parameters['q'], parameters["r_size"]
@@ -34,60 +88,146 @@ def encrypt(key, m, parameters=PARAMETERS):
     k, prf_key = key
     random_scalar = core.f(seed, prf_key, q, n)
     output = seed, ((k * random_scalar) + m) % q
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=1, reductions=1)
     #test = ([pow(seed, i, q) for i in range(1, n + 1)], output[1])
     #assert decrypt(key, test, parameters) == m
     return output
 
+@instrumentation.operation("encryption.encrypt_many")
+def encrypt_many(key, messages, parameters=PARAMETERS):
+    # encrypt for a batch: one urandom call for the seeds, batched power sums
+    n, q, r_size = parameters['n'], parameters['q'], parameters["r_size"]
+    k, prf_key = key
+    seeds = random_vector_mod_q(r_size, q, len(messages))
+    random_scalars = core.f_many(prf_key, seeds, q, n)
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=len(seeds), reductions=len(seeds),
+                              items=len(messages))
+    return [(seed, ((k * random_scalar) + m) % q) for seed, random_scalar, m in
+            zip(seeds, random_scalars, messages)]
+
+@instrumentation.operation("encryption.decrypt")
 def decrypt(key, cryptogram, parameters=PARAMETERS):
     seed, ciphertext = cryptogram
     k, prf_key = key
-    q = parameters['q']
-    random_scalar = f(seed, prf_key, q, parameters['q'])
+    q, n = parameters['q'], parameters['n']
+    seeds = _compressed_seeds(seed)
+    if seeds is None:
+        # building the powers once and taking one dot product is cheaper than
+        # f, which reduces twice per entry; a PreparedSecretKey has them cached
+        random_scalar = prepare_secret_key(key, parameters).random_scalar(seed)
+    else:
+        random_scalar = sum(core.f_many(prf_key, seeds, q, n))
     plaintext = (ciphertext - (k * random_scalar)) % q
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=1, reductions=1)
     return plaintext
 
+@instrumentation.operation("encryption.decrypt_many")
+def decrypt_many(key, cryptograms, parameters=PARAMETERS):
+    """ usage: decrypt_many(key, cryptograms, parameters=PARAMETERS) => [m, ...]
+
+        Decrypts a batch under one key. The seeds of every compressed and
+        lazy ciphertext share one batch of power sums, and uncompressed
+        ciphertexts take one dot product each against PRF powers that are
+        built once for the batch (or taken from a PreparedSecretKey). """
+    k, prf_key = key
+    q, n = parameters['q'], parameters['n']
+    seeds = []
+    spans = []
+    cryptograms = list(cryptograms)
+    for seed, ciphertext in cryptograms:
+        compressed = _compressed_seeds(seed)
+        if compressed is None:
+            spans.append(None)
+        else:
+            spans.append((len(seeds), len(seeds) + len(compressed)))
+            seeds.extend(compressed)
+    random_scalars = core.f_many(prf_key, seeds, q, n)
+    if instrumentation.enabled:
+        instrumentation.count(multiplications=len(cryptograms),
+                              reductions=len(cryptograms), items=len(cryptograms))
+    prepared = None
+    output = []
+    for (seed, ciphertext), span in zip(cryptograms, spans):
+        if span is None:
+            if prepared is None:
+                prepared = prepare_secret_key(key, parameters)
+            random_scalar = prepared.random_scalar(seed)
+        else:
+            # the power sums of a lazy sum are added unreduced
+            random_scalar = sum(random_scalars[span[0]:span[1]])
+        output.append((ciphertext - (k * random_scalar)) % q)
+    return output
+
+def densify(cryptogram, parameters=PARAMETERS):
+    # convert a compressed or lazy ciphertext to the uncompressed form
+    seed, ciphertext = cryptogram
+    seeds = _compressed_seeds(seed)
+    if seeds is None:
+        return cryptogram
+    return core.sum_of_powers(seeds, parameters['q'], parameters['n']), ciphertext
+
 def add_ciphertexts(c1, c2, parameters=PARAMETERS):
+    # sums of fresh ciphertexts keep their seeds compressed in a SeedSum until
+    # that is larger than the uncompressed form; uncompressed (e.g. scaled)
+    # inputs make the output uncompressed
     q, n = parameters['q'], parameters['n']
     assert isinstance(c1, list) or isinstance(c1, tuple), type(c1)
     assert isinstance(c2, list) or isinstance(c2, tuple), type(c2)
-    seed1 = c1[0]; seed2 = c2[0];
-    #assert isinstance(seed1, int), type(seed1)
-    #assert isinstance(seed2, int), type(seed2)
-    seed3 = core.decompress_and_add(seed1, seed2, q, n)
-    return (seed3, (c1[1] + c2[1]) % q)
+    seeds1 = _compressed_seeds(c1[0]); seeds2 = _compressed_seeds(c2[0])
+    if seeds1 is None or seeds2 is None:
+        return add_scaled_ciphertexts(densify(c1, parameters),
+                                      densify(c2, parameters), parameters)
+    output = (SeedSum(seeds1 + seeds2), (c1[1] + c2[1]) % q)
+    if len(output[0]) > n:
+        return densify(output, parameters)
+    return output
 
 def add_scaled_ciphertexts(c1, c2, parameters=PARAMETERS):
     q, n = parameters['q'], parameters['n']
     assert isinstance(c1, list) or isinstance(c1, tuple), type(c1)
     assert isinstance(c2, list) or isinstance(c2, tuple), type(c2)
-    seed1 = c1[0]; seed2 = c2[0];
-    #assert isinstance(seed1, int), type(seed1)
-    #assert isinstance(seed2, int), type(seed2)
+    seed1 = densify(c1, parameters)[0]; seed2 = densify(c2, parameters)[0]
     seed3 = core.add_vector(seed1, seed2, q)
     return (seed3, (c1[1] + c2[1]) % q)
 
 def scale_ciphertext(cryptogram, scalar, parameters=PARAMETERS):
     q = parameters['q']; n = parameters['n']
     seed, ciphertext = cryptogram
-    seed_out = []
-    seed_temp = seed
-    for i in range(1, n): # do last append after loop to avoid doing extra work
-        seed_out.append((scalar * seed_temp) % q)
-        seed_temp = (seed_temp * seed) % q
-    seed_out.append((scalar * seed_temp) % q)
-    return seed_out, (scalar * ciphertext) % q
+    if isinstance(seed, SeedSum):
+        seed = densify(cryptogram, parameters)[0]
+    if isinstance(seed, list) or isinstance(seed, tuple):
+        return core.scale_vector(seed, scalar, q), (scalar * ciphertext) % q
+    return core.powers(seed, q, n, scalar), (scalar * ciphertext) % q
 
-def serialize_key(key):
-    return bytes(key)
+def serialize_key(key, parameters=PARAMETERS):
+    return serialization.encode(serialization.KEY, key, parameters)
 
-def deserialize_key(key):
-    return ast.literal_eval(key)
+def deserialize_key(key, parameters=PARAMETERS):
+    return tuple(serialization.decode(key, (serialization.KEY, ), parameters)[1])
 
-def serialize_ciphertext(ciphertext):
-    return bytes(ciphertext)
+def serialize_ciphertext(ciphertext, parameters=PARAMETERS):
+    seed, scalar = ciphertext
+    if isinstance(seed, list) or isinstance(seed, tuple):
+        return serialization.encode(serialization.CIPHERTEXT,
+                                    list(seed) + [scalar], parameters)
+    elif isinstance(seed, SeedSum):
+        return serialization.encode(serialization.SEED_SUM,
+                                    list(seed.seeds) + [scalar], parameters)
+    return serialization.encode(serialization.COMPRESSED_CIPHERTEXT,
+                                (seed, scalar), parameters)
 
-def deserialize_ciphertext(serialized_ciphertext):
-    return ast.literal_eval(serialized_ciphertext)
+def deserialize_ciphertext(serialized_ciphertext, parameters=PARAMETERS):
+    tags = (serialization.COMPRESSED_CIPHERTEXT, serialization.CIPHERTEXT,
+            serialization.SEED_SUM)
+    tag, elements = serialization.decode(serialized_ciphertext, tags, parameters)
+    if tag == serialization.CIPHERTEXT:
+        return elements[:-1], elements[-1]
+    elif tag == serialization.SEED_SUM:
+        return SeedSum(elements[:-1]), elements[-1]
+    return elements[0], elements[1]
 
 def test_serialize_deserialize():
     print("Testing encryption.py serialization...")
@@ -100,8 +240,72 @@ def test_serialize_deserialize():
     serialized_ciphertext = serialize_ciphertext(ciphertext)
     _ciphertext = deserialize_ciphertext(serialized_ciphertext)
     assert _ciphertext == ciphertext
+
+    ciphertext = add_ciphertexts(ciphertext, encrypt(key, 1))
+    serialized_ciphertext = serialize_ciphertext(ciphertext)
+    _ciphertext = deserialize_ciphertext(serialized_ciphertext)
+    assert _ciphertext == ciphertext
+
+    ciphertext = densify(ciphertext)
+    serialized_ciphertext = serialize_ciphertext(ciphertext)
+    assert len(serialized_ciphertext) == serialization.encoded_size(
+                                        serialization.CIPHERTEXT, PARAMETERS)
+    _ciphertext = deserialize_ciphertext(serialized_ciphertext)
+    assert _ciphertext == ciphertext
     print("Serialization test complete")
 
+def test_seed_sums():
+    print("Testing lazy ciphertext sums...")
+    key = generate_secret_key()
+    ciphertext = encrypt(key, 1)
+    assert decrypt(key, ciphertext) == 1
+    for count in range(2, N + 1):
+        ciphertext = add_ciphertexts(ciphertext, encrypt(key, 1))
+        assert isinstance(ciphertext[0], SeedSum) and len(ciphertext[0]) == count
+        assert decrypt(key, ciphertext) == count
+    assert decrypt(key, densify(ciphertext)) == N
+    # larger than the uncompressed form
+    ciphertext = add_ciphertexts(ciphertext, encrypt(key, 1))
+    assert isinstance(ciphertext[0], list) and len(ciphertext[0]) == N
+    assert decrypt(key, ciphertext) == N + 1
+
+    lazy = add_ciphertexts(encrypt(key, 2), encrypt(key, 3))
+    scaled = scale_ciphertext(encrypt(key, 1), 5)
+    for mixed in (add_ciphertexts(lazy, scaled), add_ciphertexts(scaled, lazy),
+                  add_scaled_ciphertexts(lazy, scaled)):
+        assert isinstance(mixed[0], list)
+        assert decrypt(key, mixed) == 10
+    assert decrypt(key, scale_ciphertext(lazy, 3)) == 15
+    print("Lazy sum test complete")
+
+def test_encrypt_decrypt_many():
+    print("Testing batch encryption...")
+    key = generate_secret_key()
+    messages = list(range(40))
+    ciphertexts = encrypt_many(key, messages)
+    assert decrypt_many(key, ciphertexts) == messages
+    assert [decrypt(key, ciphertext) for ciphertext in ciphertexts] == messages
+    ciphertexts[3] = add_ciphertexts(ciphertexts[3], ciphertexts[4])
+    ciphertexts[5] = scale_ciphertext(ciphertexts[5], 2)
+    messages[3] += messages[4]; messages[5] *= 2
+    assert decrypt_many(key, ciphertexts) == messages
+    assert decrypt_many(key, []) == []
+    ciphertexts[6] = densify(add_ciphertexts(ciphertexts[6], ciphertexts[7]))
+    messages[6] += messages[7]
+    prepared = prepare_secret_key(key)
+    assert decrypt_many(prepared, ciphertexts) == messages
+    assert [decrypt(prepared, ciphertext) for ciphertext in ciphertexts] == messages
+    k, prf_key = prepared
+    assert (k, prf_key) == key
+    for bad in ((ciphertexts[6][0][1:], 0), (tuple(ciphertexts[6][0]) + (1, ), 0)):
+        try:
+            decrypt(prepared, bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Accepted a ciphertext of the wrong shape")
+    print("Batch encryption test complete")
+
 def test_encrypt_decrypt():
     test_count = 1024
     print("Testing correctness of encryption...")
@@ -146,37 +350,17 @@ def test_encrypt_decrypt():
         plaintext_r_02 = decrypt(key, ciphertext_of_r_02)
         assert plaintext_r_02 == plaintext_r == random_scalar
 
-    print("Testing performance of encryption...")
-    from timeit import default_timer
-    before = default_timer()
-    for count in range(test_count):
-        encrypt(key, message)
-    after = default_timer()
-    enc_time = after - before
-
-    ciphertext = (decompress(ciphertext[0], Q, N), ciphertext[1])
-    before = default_timer()
-    for count in range(test_count):
-        decrypt(key, ciphertext)
-    after = default_timer()
-    dec_time = after - before
-
-
     q_size = PARAMETERS["security_level"]; n = PARAMETERS['n']
     key_size = q_size + q_size
     uncompressed_key_size = q_size + (q_size * n)
     cryptogram1 = q_size + q_size
     cryptogram2 = q_size + (q_size * n)
 
-    messages = ("Time taken to encrypt {} messages: {} seconds",
-                "Time taken to decrypt {} messages: {} seconds",
-                "Key size: {} bits ({} bytes) (compressed)",
+    messages = ("Key size: {} bits ({} bytes) (compressed)",
                 "Key size: {} bits ({} bytes) (uncompressed)",
                 "Ciphertext (fresh) size: {} bits ({} bytes) (expansion: {})",
                 "Ciphertext (added) size: {} bits ({} bytes) (expansion: {})")
-    inserts = ((test_count, enc_time),        # using tuples makes the * below work nicely
-               (test_count, dec_time),
-               (key_size, key_size / 8),
+    inserts = ((key_size, key_size / 8),      # using tuples makes the * below work nicely
                (uncompressed_key_size, uncompressed_key_size / 8),
                (cryptogram1, cryptogram1 / 8, float(cryptogram1) / q_size),
                (cryptogram2, cryptogram2 / 8, float(cryptogram2) / q_size))
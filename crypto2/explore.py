@@ -0,0 +1,228 @@
+""" Parameter-space explorer: size/speed trade-offs per security level.
+
+    usage: python explore.py [--security-level K ...] [--budget BYTES ...]
+                             [--q-size BITS ...] [--n N ...]
+                             [--operation NAME ...] [--iterations N]
+                             [--warmup N] [--output FILE]
+
+    Every combination of security level, q size and n is built once and
+    cached. When no n is given, each byte budget picks the largest n whose
+    serialized signature fits in it, which is how generate_parameters sizes
+    n for a single packet. For each candidate the wire sizes of keys,
+    signatures and cryptograms are read from the serialization format, and
+    the operations are timed with benchmark.time_operation. The result is
+    printed as a table and can be written as JSON.
+
+    Warning: secure parameterization for 'n' is not established; the table
+    measures cost, not security. """
+import argparse
+import json
+import sys
+
+import benchmark
+import serialization
+from parameters import PARAMETER_SETS, build_parameters, generate_q
+
+OPERATIONS = ("signature.keygen", "signature.sign", "signature.verify",
+              "kem.keygen", "kem.encapsulate", "kem.recover",
+              "encryption.decrypt")
+
+# wire format name, type tag
+WIRE_SIZES = (("signature", serialization.SIGNATURE),
+              ("signature_public_key", serialization.SIGNATURE_PUBLIC_KEY),
+              ("kem_public_key", serialization.PUBLIC_KEY),
+              ("cryptogram", serialization.CIPHERTEXT),
+              ("ciphertext", serialization.COMPRESSED_CIPHERTEXT),
+              ("secret_key", serialization.KEY))
+
+_SHORT_NAMES = {"signature.keygen" : "sig_keygen", "signature.sign" : "sign",
+                "signature.verify" : "verify", "kem.keygen" : "kem_keygen",
+                "kem.encapsulate" : "encaps", "kem.recover" : "recover",
+                "encryption.decrypt" : "decrypt"}
+
+# q for each q_size; the named sets already know theirs
+_PRIMES = dict((spec["q_size"], spec['q']) for spec in PARAMETER_SETS.values())
+_PARAMETERS = {}
+
+def find_q(q_size):
+    # the prime search takes seconds for large q_size, so it is done once
+    try:
+        return _PRIMES[q_size]
+    except KeyError:
+        q = _PRIMES[q_size] = generate_q(q_size)
+        return q
+
+def get_candidate(security_level, q_size, n):
+    """ usage: get_candidate(security_level, q_size, n) => parameters
+
+        Builds the parameter set on first use and caches it. The seed is
+        derived from the arguments, so G is the same in every run. """
+    key = (security_level, q_size, n)
+    try:
+        return _PARAMETERS[key]
+    except KeyError:
+        name = "explore-{}-{}-{}".format(*key)
+        parameters = _PARAMETERS[key] = build_parameters(security_level, q_size,
+                                                         find_q(q_size), n,
+                                                         name, name)
+        return parameters
+
+def wire_sizes(parameters):
+    # => {format name : bytes on the wire}
+    return dict((name, serialization.encoded_size(tag, parameters)) for
+                name, tag in WIRE_SIZES)
+
+def largest_n(budget, q):
+    """ usage: largest_n(budget, q) => n
+
+        The largest n whose serialized signature fits in budget bytes. """
+    header = serialization.encoded_size(serialization.SIGNATURE,
+                                        {'q' : q, 'n' : 0})
+    n = (budget - header) // (2 * serialization.element_size(q))
+    if n < 1:
+        raise ValueError("A signature does not fit in {} bytes".format(budget))
+    return n
+
+def candidates(security_levels=(128, ), budgets=(1500, ), q_sizes=None,
+               ns=None):
+    """ usage: candidates(security_levels=(128, ), budgets=(1500, ),
+                          q_sizes=None, ns=None) => entries
+
+        entries are (security_level, q_size, n, budget) tuples.
+        q_sizes defaults to twice the security level. With explicit ns the
+        budget of every candidate is None. """
+    output = []
+    for security_level in security_levels:
+        for q_size in q_sizes or (2 * security_level, ):
+            if ns:
+                choices = [(n, None) for n in ns]
+            else:
+                q = find_q(q_size)
+                choices = [(largest_n(budget, q), budget) for budget in budgets]
+            for n, budget in choices:
+                entry = (security_level, q_size, n, budget)
+                if entry not in output:
+                    output.append(entry)
+    return output
+
+def explore(entries, operations=OPERATIONS, iterations=64, warmup=4,
+            stream=None):
+    """ usage: explore(entries, operations=OPERATIONS, iterations=64,
+                       warmup=4, stream=None) => rows
+
+        entries are (security_level, q_size, n, budget) as returned by
+        candidates. Each row holds the entry, the wire sizes and the timing
+        summary of every operation. """
+    factories = dict(benchmark.BENCHMARKS)
+    rows = []
+    for security_level, q_size, n, budget in entries:
+        parameters = get_candidate(security_level, q_size, n)
+        sizes = wire_sizes(parameters)
+        timings = {}
+        for operation in operations:
+            timings[operation] = benchmark.time_operation(
+                                 factories[operation](parameters), iterations,
+                                 warmup)
+        row = {"security_level" : security_level, "q_size" : q_size, 'n' : n,
+               "budget" : budget, "sizes" : sizes, "timings" : timings,
+               "fits" : budget is None or sizes["signature"] <= budget}
+        rows.append(row)
+        if stream is not None:
+            stream.write(format_table([row], operations, len(rows) == 1))
+            stream.flush()
+    return rows
+
+def format_table(rows, operations=OPERATIONS, header=True):
+    """ usage: format_table(rows, operations=OPERATIONS, header=True) => text
+
+        One line per row: the candidate, the signature, public key and
+        cryptogram sizes in bytes, then operations per second (from the
+        median) for each operation. """
+    columns = ["level", "q_size", 'n', "budget", "sig", "sig_pk", "kem_pk",
+               "crypt"] + [_SHORT_NAMES.get(operation, operation) for operation
+                           in operations]
+    widths = [max(len(column), 8) for column in columns]
+    lines = []
+    if header:
+        lines.append(' '.join(column.rjust(width) for column, width in
+                              zip(columns, widths)))
+    for row in rows:
+        sizes = row["sizes"]
+        cells = [row["security_level"], row["q_size"], row['n'],
+                 '-' if row["budget"] is None else row["budget"],
+                 sizes["signature"], sizes["signature_public_key"],
+                 sizes["kem_public_key"], sizes["cryptogram"]]
+        cells.extend("{:.1f}".format(row["timings"][operation]["ops_per_second"])
+                     for operation in operations)
+        lines.append(' '.join(str(cell).rjust(width) for cell, width in
+                              zip(cells, widths)))
+    return ''.join(line + '\n' for line in lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="crypto2 parameter explorer")
+    parser.add_argument("--security-level", type=int, action="append")
+    parser.add_argument("--budget", type=int, action="append",
+                        help="bytes available for a signature")
+    parser.add_argument("--q-size", type=int, action="append")
+    parser.add_argument("--n", type=int, action="append")
+    parser.add_argument("--operation", action="append", choices=OPERATIONS)
+    parser.add_argument("--iterations", type=int, default=64)
+    parser.add_argument("--warmup", type=int, default=4)
+    parser.add_argument("--output")
+    arguments = parser.parse_args(argv)
+
+    entries = candidates(arguments.security_level or (128, ),
+                         arguments.budget or (1500, ), arguments.q_size,
+                         arguments.n)
+    operations = arguments.operation or OPERATIONS
+    rows = explore(entries, operations, arguments.iterations, arguments.warmup,
+                   sys.stdout)
+    if arguments.output:
+        with open(arguments.output, 'w') as _file:
+            json.dump({"metadata" : {"iterations" : arguments.iterations,
+                                     "warmup" : arguments.warmup},
+                       "rows" : rows}, _file, indent=4, sort_keys=True)
+    return 0
+
+def test_explore():
+    import signature
+    import kem
+    print("Testing explore.py...")
+    assert largest_n(1500, PARAMETER_SETS["crypto2-128"]['q']) == 22
+    entries = candidates((128, ), (600, 1500))
+    assert entries == [(128, 256, 9, 600), (128, 256, 22, 1500)]
+    assert candidates((128, ), q_sizes=(256, ), ns=(4, 4)) == [(128, 256, 4, None)]
+    parameters = get_candidate(128, 256, 9)
+    assert get_candidate(128, 256, 9) is parameters
+    assert parameters["security_level"] == 128 and parameters['n'] == 9
+
+    sizes = wire_sizes(parameters)
+    public_key, private_key = signature.generate_keypair(parameters)
+    signed = signature.sign(private_key, "explore", parameters)
+    assert sizes["signature"] == len(signature.serialize_signature(signed,
+                                                                   parameters))
+    assert sizes["signature_public_key"] == len(signature.serialize_public_key(
+                                                public_key, parameters))
+    kem_public, kem_private = kem.generate_keypair(parameters)
+    secret, cryptogram = kem.encapsulate_secret(kem_public, parameters)
+    assert sizes["kem_public_key"] == len(kem.serialize_public_key(kem_public,
+                                                                   parameters))
+    assert sizes["cryptogram"] == len(kem.serialize_cryptogram(cryptogram,
+                                                               parameters))
+
+    rows = explore(entries[:1], ("signature.verify", "kem.recover"),
+                   iterations=2, warmup=1)
+    assert rows[0]["fits"] and rows[0]["sizes"]["signature"] <= 600
+    assert set(rows[0]["timings"]) == set(["signature.verify", "kem.recover"])
+    table = format_table(rows, ("signature.verify", "kem.recover"))
+    assert len(table.splitlines()) == 2
+    try:
+        largest_n(10, parameters['q'])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Fitted a signature in 10 bytes")
+    print("Explore test complete")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+""" Opt-in operation counters and latency histograms.
+
+    Disabled by default; the hooks in the arithmetic kernels then cost one
+    attribute check each. When enabled, every public operation (decorated
+    with operation(name)) records its latency, and the work done inside it is
+    counted under its name:
+
+    - multiplications, reductions: big integer products and % q reductions
+    - pow, inversions: modular exponentiations and inverses
+    - urandom_calls, urandom_bytes: calls to os.urandom and bytes requested
+    - hash_calls: message hashes and HMAC blocks
+    - items: entries processed by batch operations
+
+    Batch entry points are recorded under their own names (for example
+    encryption.encrypt_many and signature.verify_batch), so a call counts
+    once and its latency covers the whole batch; divide by items for
+    per-entry figures.
+
+    Nested operations are attributed to the outermost one, so keygen inside
+    sign counts towards sign. Work outside of any operation is counted under
+    "other".
+
+    usage: instrumentation.enable()
+           ...
+           instrumentation.snapshot() => {operation : {...}, ...}
+           instrumentation.reset()
+
+           with instrumentation.measure() as recorder:
+               ...
+           recorder.snapshot()
+
+    A measure() block records the work of its own thread into a fresh
+    Recorder. Blocks may nest or overlap, in one thread or several; the
+    global counters keep recording as before while enable() is on. """
+import contextlib
+import functools
+import threading
+from timeit import default_timer
+
+COUNTERS = ("multiplications", "reductions", "pow", "inversions",
+            "urandom_calls", "urandom_bytes", "hash_calls", "items")
+
+# upper bounds of the latency histogram buckets in seconds: 1us, 2us, ... 8s
+BUCKETS = tuple(1e-6 * (2 ** index) for index in range(24))
+
+# read by the hooks: true while enable() is on or any measure() block is open
+enabled = False
+
+_lock = threading.Lock()
+_state = threading.local()
+_enabled = False
+_scopes = 0
+
+class Recorder(object):
+    """ usage: Recorder() => recorder
+
+        Counters and latency histograms per operation name. """
+
+    __slots__ = ("operations", )
+
+    def __init__(self):
+        self.operations = {}
+
+    def _entry(self, name):
+        entry = self.operations.get(name)
+        if entry is None:
+            entry = self.operations[name] = {"calls" : 0, "seconds" : 0.0,
+                                             "counters" : dict.fromkeys(COUNTERS, 0),
+                                             "histogram" : [0] * (len(BUCKETS) + 1)}
+        return entry
+
+    def add(self, name, amounts):
+        counters = self._entry(name)["counters"]
+        for counter, amount in amounts.items():
+            counters[counter] += amount
+
+    def record(self, name, elapsed):
+        entry = self._entry(name)
+        entry["calls"] += 1
+        entry["seconds"] += elapsed
+        index = 0
+        while index < len(BUCKETS) and elapsed > BUCKETS[index]:
+            index += 1
+        entry["histogram"][index] += 1
+
+    def snapshot(self):
+        """ usage: recorder.snapshot() => {operation : {"calls" : ...,
+                                                        "seconds" : ...,
+                                                        "counters" : {...},
+                                                        "histogram" : [...]}}
+
+            histogram holds [upper bound in seconds, count] for every
+            non-empty bucket; the bound of the overflow bucket is None. """
+        output = {}
+        for name, entry in self.operations.items():
+            bounds = BUCKETS + (None, )
+            output[name] = {"calls" : entry["calls"],
+                            "seconds" : entry["seconds"],
+                            "counters" : dict(entry["counters"]),
+                            "histogram" : [[bound, count] for bound, count in
+                                           zip(bounds, entry["histogram"]) if
+                                           count]}
+        return output
+
+    def reset(self):
+        self.operations = {}
+
+_recorder = Recorder()
+
+def _update():
+    # called with _lock held
+    global enabled
+    enabled = _enabled or _scopes > 0
+
+def enable():
+    global _enabled
+    with _lock:
+        _enabled = True
+        _update()
+
+def disable():
+    global _enabled
+    with _lock:
+        _enabled = False
+        _update()
+
+def _recorders():
+    # the recorders that work on the calling thread is counted into
+    output = list(getattr(_state, "recorders", ()))
+    if _enabled:
+        output.append(_recorder)
+    return output
+
+def snapshot():
+    with _lock:
+        return _recorder.snapshot()
+
+def reset():
+    with _lock:
+        _recorder.reset()
+
+@contextlib.contextmanager
+def measure():
+    """ usage: with measure() as recorder: ...
+
+        Records the work done by the calling thread during the block into a
+        fresh Recorder, in addition to any enclosing block and the global
+        counters. """
+    global _scopes
+    recorder = Recorder()
+    stack = getattr(_state, "recorders", None)
+    if stack is None:
+        stack = _state.recorders = []
+    stack.append(recorder)
+    with _lock:
+        _scopes += 1
+        _update()
+    try:
+        yield recorder
+    finally:
+        stack.remove(recorder)
+        with _lock:
+            _scopes -= 1
+            _update()
+
+def count(**amounts):
+    # called from the kernels as: if instrumentation.enabled: count(...)
+    recorders = _recorders()
+    if not recorders:
+        return
+    name = getattr(_state, "operation", None) or "other"
+    with _lock:
+        for recorder in recorders:
+            recorder.add(name, amounts)
+
+def operation(name):
+    """ usage: @operation(name) => decorator
+
+        Records the latency of the outermost call and attributes the work
+        counted during it to name. """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled or getattr(_state, "operation", None) is not None:
+                return function(*args, **kwargs)
+            recorders = _recorders()
+            if not recorders:
+                return function(*args, **kwargs)
+            _state.operation = name
+            start = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = default_timer() - start
+                _state.operation = None
+                with _lock:
+                    for recorder in recorders:
+                        recorder.record(name, elapsed)
+        return wrapper
+    return decorator
+
+def test_instrumentation():
+    import core
+    import encryption
+    import kem
+    import signature
+    from parameters import PARAMETERS
+    print("Testing instrumentation.py...")
+    q, n = PARAMETERS['q'], PARAMETERS['n']
+    assert not enabled
+    key = encryption.generate_secret_key()
+    public, private = signature.generate_keypair()
+    kem_public, kem_private = kem.generate_keypair()
+    with measure() as recorder:
+        core.powers(3, q, n)
+        ciphertext = encryption.encrypt(key, 1)
+        assert encryption.decrypt(key, ciphertext) == 1
+        signed = signature.sign(private, "message")
+        assert signature.verify(public, "message", signed)
+        secret, cryptogram = kem.encapsulate_secret(kem_public)
+        assert kem.recover_secret(kem_private, cryptogram) == secret
+        kem.generate_keypair()
+    assert not enabled
+    output = recorder.snapshot()
+    assert output["other"]["counters"]["multiplications"] == n + 1
+    assert output["other"]["calls"] == 0
+    for name in ("encryption.encrypt", "encryption.decrypt", "signature.sign",
+                 "signature.verify", "kem.encapsulate", "kem.recover",
+                 "kem.keygen"):
+        entry = output[name]
+        assert entry["calls"] == 1, name
+        assert sum(count for bound, count in entry["histogram"]) == 1
+        assert entry["counters"]["multiplications"] > 0, name
+    assert output["signature.sign"]["counters"]["hash_calls"] == 1
+    assert output["signature.sign"]["counters"]["urandom_calls"] > 0
+    assert "signature.keygen" not in output
+
+    ciphertexts = encryption.encrypt_many(key, [1] * 5)
+    with measure() as recorder:
+        assert encryption.decrypt_many(key, ciphertexts) == [1] * 5
+        assert signature.verify_batch([(public, "message", signed)] * 3) == [True] * 3
+    output = recorder.snapshot()
+    assert sorted(output) == ["encryption.decrypt_many", "signature.verify_batch"]
+    assert output["encryption.decrypt_many"]["calls"] == 1
+    assert output["encryption.decrypt_many"]["counters"]["items"] == 5
+    assert output["signature.verify_batch"]["counters"]["items"] == 3
+    assert snapshot() == {}
+
+    # overlapping blocks exiting out of order, another thread's work
+    first = measure(); a = first.__enter__()
+    second = measure(); b = second.__enter__()
+    core.powers(3, q, n)
+    first.__exit__(None, None, None)
+    core.powers(3, q, n)
+    worker = threading.Thread(target=core.powers, args=(3, q, n))
+    worker.start(); worker.join()
+    second.__exit__(None, None, None)
+    assert not enabled and snapshot() == {}
+    assert a.snapshot()["other"]["counters"]["multiplications"] == n + 1
+    assert b.snapshot()["other"]["counters"]["multiplications"] == 2 * (n + 1)
+    enable()
+    try:
+        with measure() as recorder:
+            core.powers(3, q, n)
+        worker = threading.Thread(target=core.powers, args=(3, q, n))
+        worker.start(); worker.join()
+    finally:
+        disable()
+    assert recorder.snapshot()["other"]["counters"]["multiplications"] == n + 1
+    assert snapshot()["other"]["counters"]["multiplications"] == 2 * (n + 1)
+    reset()
+    print("Instrumentation test complete")
@@ -1,18 +1,20 @@
-import ast
-
+import core
 import encryption
+import instrumentation
+import linearalgebra
+import serialization
 from parameters import PARAMETERS
-from utilities import random_integer_mod_q
+from utilities import random_integer_mod_q, random_vector_mod_q
 
 def generate_private_key(parameters=PARAMETERS):
     return encryption.generate_secret_key(parameters)
 
 def generate_public_key(private_key, parameters=PARAMETERS):
     # WARNING: Do not output more than n points or the key will leak
-    encrypt = encryption.encrypt
-    return [encrypt(private_key, 1)] + [encrypt(private_key, 0) for count in
-                                        range(parameters['n'] - 1)]
+    messages = [1] + ([0] * (parameters['n'] - 1))
+    return encryption.encrypt_many(private_key, messages, parameters)
 
+@instrumentation.operation("kem.keygen")
 def generate_keypair(parameters=PARAMETERS):
     private_key = generate_private_key(parameters)
     public_key = generate_public_key(private_key, parameters)
@@ -20,37 +22,102 @@ def generate_keypair(parameters=PARAMETERS):
         raise SystemExit("Generated insecure keypair")
     return public_key, private_key
 
-def encapsulate_secret(public_key, parameters=PARAMETERS):
-    q, r_size, n = parameters['q'], parameters["r_size"], parameters['n']
-    scalar = secret = random_integer_mod_q(r_size, q)
-    output = ([0] * n, 0)
-    for i, entry in enumerate(public_key):
-        scaled_entry = encryption.scale_ciphertext(entry, scalar, parameters)
-        output = encryption.add_scaled_ciphertexts(output, scaled_entry,
-                                                   parameters)
-        scalar = (scalar * secret) % q
-    return secret, output
+class PreparedPublicKey(object):
+    """ A public key with the powers of each seed decompressed once.
+
+        matrix row i holds the powers of seed i followed by scalar i, so a
+        batch of encapsulations is the matrix of secret powers times matrix. """
+
+    __slots__ = ("public_key", "matrix", "parameters")
+
+    def __init__(self, public_key, parameters=PARAMETERS):
+        q, n = parameters['q'], parameters['n']
+        rows = [core.powers(seed, q, n) + [scalar] for seed, scalar in public_key]
+        self.public_key = public_key
+        self.matrix = linearalgebra.Matrix(rows, q)
+        self.parameters = parameters
+
+    @property
+    def columns(self):
+        return self.matrix.columns[:-1]
+
+    @property
+    def scalars(self):
+        return self.matrix.columns[-1]
+
+    def encapsulate(self, secret):
+        return self.encapsulate_many([secret])[0]
 
+    def encapsulate_many(self, secrets):
+        # => [(seed vector, scalar), ...]
+        q = self.parameters['q']; n = len(self.public_key)
+        weights = linearalgebra.power_matrix(secrets, q, n)
+        return [(list(row[:-1]), row[-1]) for row in
+                weights.multiply(self.matrix).rows]
+
+def prepare_public_key(public_key, parameters=PARAMETERS):
+    if isinstance(public_key, PreparedPublicKey):
+        return public_key
+    return PreparedPublicKey(public_key, parameters)
+
+@instrumentation.operation("kem.encapsulate")
+def encapsulate_secret(public_key, parameters=PARAMETERS):
+    public_key = prepare_public_key(public_key, parameters)
+    secret = random_integer_mod_q(parameters["r_size"], parameters['q'])
+    return secret, public_key.encapsulate(secret)
+
+@instrumentation.operation("kem.encapsulate_many")
+def encapsulate_many(public_key, count, parameters=PARAMETERS):
+    """ usage: encapsulate_many(public_key, count,
+                                parameters=PARAMETERS) => [(secret, cryptogram), ...]
+
+        Encapsulates count secrets to the same public key.
+        public_key may be a PreparedPublicKey, which avoids decompressing it. """
+    public_key = prepare_public_key(public_key, parameters)
+    secrets = random_vector_mod_q(parameters["r_size"], parameters['q'], count)
+    if instrumentation.enabled:
+        instrumentation.count(items=count)
+    return list(zip(secrets, public_key.encapsulate_many(secrets)))
+
+def prepare_private_key(private_key, parameters=PARAMETERS):
+    # for receivers that recover many secrets under one long-lived key
+    return encryption.prepare_secret_key(private_key, parameters)
+
+@instrumentation.operation("kem.recover")
 def recover_secret(private_key, encapsulated_secret, parameters=PARAMETERS):
     return encryption.decrypt(private_key, encapsulated_secret, parameters)
 
-def serialize_private_key(private_key):
-    return encryption.serialize_key(private_key)
+@instrumentation.operation("kem.recover_many")
+def recover_secret_many(private_key, encapsulated_secrets, parameters=PARAMETERS):
+    """ usage: recover_secret_many(private_key, encapsulated_secrets,
+                                   parameters=PARAMETERS) => [secret, ...] """
+    return encryption.decrypt_many(private_key, encapsulated_secrets, parameters)
+
+def serialize_private_key(private_key, parameters=PARAMETERS):
+    return encryption.serialize_key(private_key, parameters)
 
-def deserialize_private_key(serialized_key):
-    return encryption.deserialize_key(serialized_key)
+def deserialize_private_key(serialized_key, parameters=PARAMETERS):
+    return encryption.deserialize_key(serialized_key, parameters)
 
-def serialize_public_key(public_key):
-    return bytes(public_key)
+def serialize_public_key(public_key, parameters=PARAMETERS):
+    elements = [element for entry in public_key for element in entry]
+    return serialization.encode(serialization.PUBLIC_KEY, elements, parameters)
 
-def deserialize_public_key(serialized_key):
-    return ast.literal_eval(serialized_key)
+def deserialize_public_key(serialized_key, parameters=PARAMETERS):
+    elements = serialization.decode(serialized_key, (serialization.PUBLIC_KEY, ),
+                                    parameters)[1]
+    return [(elements[index], elements[index + 1]) for index in
+            range(0, len(elements), 2)]
 
-def serialize_cryptogram(encapsulated_secret):
-    return bytes(encapsulated_secret)
+def serialize_cryptogram(encapsulated_secret, parameters=PARAMETERS):
+    seed, scalar = encapsulated_secret
+    return serialization.encode(serialization.CIPHERTEXT, list(seed) + [scalar],
+                                parameters)
 
-def deserialize_cryptogram(serialized_cryptogram):
-    return ast.literal_eval(serialized_cryptogram)
+def deserialize_cryptogram(serialized_cryptogram, parameters=PARAMETERS):
+    elements = serialization.decode(serialized_cryptogram,
+                                    (serialization.CIPHERTEXT, ), parameters)[1]
+    return elements[:-1], elements[-1]
 
 def test_serialize_deserialize():
     print("Testing kem.py serialization...")
@@ -80,19 +147,18 @@ def test_kem():
         _secret = recover_secret(private, encapsulated)
         assert _secret == secret, (_secret, secret)
 
-    print("Testing performance of KEM...")
-    from timeit import default_timer
-    before = default_timer()
-    for count in range(test_size):
-        encapsulate_secret(public)
-    after = default_timer()
-    encaps_time = after - before
-
-    before = default_timer()
-    for count in range(test_size):
-        recover_secret(private, encapsulated)
-    after = default_timer()
-    recover_time = after - before
+    prepared = PreparedPublicKey(public)
+    pairs = encapsulate_many(prepared, 8)
+    secret = pairs[0][0]
+    assert prepared.encapsulate_many([secret]) == [prepared.encapsulate(secret)]
+    for secret, encapsulated in pairs:
+        assert recover_secret(private, encapsulated) == secret
+    secrets = [secret for secret, encapsulated in pairs]
+    cryptograms = [encapsulated for secret, encapsulated in pairs]
+    assert recover_secret_many(private, cryptograms) == secrets
+    private = prepare_private_key(private)
+    assert recover_secret_many(private, cryptograms) == secrets
+    assert serialize_private_key(private) == serialize_private_key(tuple(private))
 
     q_size = PARAMETERS["security_level"]; n = PARAMETERS['n']
     pub_entry_size = q_size + q_size             #      compressed seed + scalar
@@ -100,15 +166,11 @@ def test_kem():
     priv_size = q_size + (q_size * n)            # scalar + uncompressed prf key
     comp_size = q_size + q_size                  #   scalar + compressed prf key
     cryptogram_size = (q_size * n) + q_size      #    uncompressed seed + scalar
-    messages = ["Time taken to encapsulate {} keys: {} seconds",
-                "Taken taken to recover    {} keys: {} seconds",
-                "Public key size : {} bits ({} bytes)",
+    messages = ["Public key size : {} bits ({} bytes)",
                 "Private key size: {} bits ({} bytes) (uncompressed)",
                 "Private key size: {} bits ({} bytes) (compressed)",
                 "Cryptogram size : {} bits ({} bytes)"]
-    inserts = [(test_size, encaps_time),
-               (test_size, recover_time),
-               (pub_size, pub_size / 8),
+    inserts = [(pub_size, pub_size / 8),
                (priv_size, priv_size / 8),
                (comp_size, comp_size / 8),
                (cryptogram_size, cryptogram_size / 8)]
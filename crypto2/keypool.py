@@ -0,0 +1,113 @@
+import multiprocessing
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import signature
+from parameters import PARAMETERS
+
+class EphemeralKeyPool(object):
+    """ usage: EphemeralKeyPool(parameters=PARAMETERS, low_water=32,
+                                high_water=128, threads=1, processes=0,
+                                batch_size=8) => pool
+
+        Keeps ephemeral signing keypairs ready for signature.sign(..., pool=pool).
+
+        Background threads refill the pool up to high_water whenever it
+        drops to low_water or below. With processes > 0 the keypairs are
+        generated in a process pool, so filling does not compete with the
+        signing thread for the GIL. Every keypair is handed out exactly
+        once; get() generates one inline if the pool is empty. """
+
+    def __init__(self, parameters=PARAMETERS, low_water=32, high_water=128,
+                 threads=1, processes=0, batch_size=8):
+        if not 0 <= low_water < high_water:
+            raise ValueError("Require 0 <= low_water < high_water")
+        self.parameters = parameters
+        self.low_water = low_water
+        self.high_water = high_water
+        self.batch_size = batch_size
+        self._keys = queue.Queue()
+        self._condition = threading.Condition()
+        self._filling = True
+        self._closed = False
+        self._process_pool = multiprocessing.Pool(processes) if processes else None
+        self._threads = []
+        for count in range(max(threads, processes, 1)):
+            thread = threading.Thread(target=self._fill)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __len__(self):
+        return self._keys.qsize()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.close()
+
+    def _generate(self, count):
+        if self._process_pool is None:
+            return signature.generate_ephemeral_keys(count, self.parameters)
+        return self._process_pool.apply(signature.generate_ephemeral_keys,
+                                        (count, self.parameters))
+
+    def _fill(self):
+        while True:
+            with self._condition:
+                while self._filling is False and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+            missing = self.high_water - self._keys.qsize()
+            for key in self._generate(max(1, min(self.batch_size, missing))):
+                self._keys.put(key)
+            with self._condition:
+                if self._keys.qsize() >= self.high_water:
+                    self._filling = False
+
+    def get(self):
+        """ usage: pool.get() => (pub2, ephemeral_columns)
+
+            Removes and returns a ready ephemeral keypair. """
+        try:
+            key = self._keys.get_nowait()
+        except queue.Empty:
+            key = signature.generate_ephemeral_key(self.parameters)
+        if self._keys.qsize() <= self.low_water:
+            with self._condition:
+                if self._filling is False:
+                    self._filling = True
+                    self._condition.notify_all()
+        return key
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if self._process_pool is not None:
+            self._process_pool.close()
+            self._process_pool.join()
+
+def test_key_pool():
+    import time
+    print("Testing ephemeral key pool...")
+    public, private = signature.generate_keypair()
+    for processes in (0, 2):
+        with EphemeralKeyPool(low_water=4, high_water=16,
+                              processes=processes) as pool:
+            deadline = time.time() + 30
+            while len(pool) < pool.high_water and time.time() < deadline:
+                time.sleep(.01)
+            assert len(pool) >= pool.high_water, len(pool)
+            keys = [pool.get() for count in range(2 * pool.high_water)]
+            assert len(set(tuple(key[0]) for key in keys)) == len(keys)
+            signed = signature.sign(private, "unit test", pool=pool)
+            assert signature.verify(public, "unit test", signed)
+    print("Key pool test complete")
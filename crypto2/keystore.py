@@ -0,0 +1,486 @@
+""" On-disk store of public keys in fixed-width records, memory-mapped read-only.
+
+    Two files make up a store:
+        PATH        header | records, where a record is
+                    key id (id_size bytes) | n entries of the public key
+        PATH.index  header | (key id, record number) entries sorted by key id
+
+    Lookups binary search the mapped index and return a KeyView over the
+    mapped record, which decodes its elements only when iterated; KeyViews
+    can be passed to kem.encapsulate_secret and signature.verify as they are.
+
+    A single writer appends records in bulk, merges their ids into a new
+    index and renames it into place. compact() rewrites both files without
+    superseded and deleted records. Both headers carry a generation number,
+    so a reader that opens the files while they are being swapped retries.
+    Any number of processes can read a store concurrently: a reader keeps
+    the files it mapped until refresh() is called. """
+import contextlib
+import hashlib
+import os
+import struct
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import serialization
+from parameters import PARAMETERS
+from utilities import as_bytes, map_file, random_bytes, unmap_file
+
+VERSION = 1
+MAGIC = b"C2KS"
+INDEX_MAGIC = b"C2KI"
+
+# magic, version, tag, id size, element size, elements per record,
+# parameters fingerprint, generation
+_HEADER = struct.Struct(">4sBBHHI16s8s")
+# magic, version, generation, number of entries, number of records covered
+_INDEX_HEADER = struct.Struct(">4sB8sQQ")
+_RECORD_NUMBER = struct.Struct(">Q")
+
+# atomically replaces the destination where python offers it
+_rename = getattr(os, "replace", os.rename)
+
+def parameters_fingerprint(parameters):
+    text = "{}:{}:{}".format(parameters['q'], parameters['n'], parameters['g'])
+    return hashlib.sha256(text.encode("ascii")).digest()[:16]
+
+def key_id(public_key, parameters=PARAMETERS, id_size=16):
+    """ usage: key_id(public_key, parameters=PARAMETERS, id_size=16) => bytes
+
+        A key id derived from the key itself, for callers without their own. """
+    entries = list(public_key)
+    if entries and isinstance(entries[0], tuple):
+        entries = [element for entry in entries for element in entry]
+    data = serialization.pack_elements(entries, parameters['q'])
+    return hashlib.sha256(data).digest()[:id_size]
+
+class KeyView(object):
+    """ A public key backed by a record of a mapped KeyStore.
+
+        Behaves as a read-only sequence of the key's n entries: (seed,
+        scalar) pairs for KEM keys and scalars for signature keys. The
+        elements are decoded from the mapping on every iteration. """
+
+    __slots__ = ("key_id", "data", "pairs", "q")
+
+    def __init__(self, key_id, data, pairs, q):
+        self.key_id = key_id
+        self.data = data
+        self.pairs = pairs
+        self.q = q
+
+    def elements(self):
+        return serialization.unpack_elements(self.data, self.q)
+
+    def to_list(self):
+        elements = self.elements()
+        if self.pairs:
+            return list(zip(elements[0::2], elements[1::2]))
+        return elements
+
+    def __len__(self):
+        size = len(self.data) // serialization.element_size(self.q)
+        return size // 2 if self.pairs else size
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, index):
+        # decodes only the addressed entry; slices decode the whole record
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("Key index out of range")
+        size = serialization.element_size(self.q)
+        width = 2 * size if self.pairs else size
+        elements = serialization.unpack_elements(
+                   self.data[index * width:(index + 1) * width], self.q)
+        return tuple(elements) if self.pairs else elements[0]
+
+    def __eq__(self, other):
+        return self.to_list() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+class KeyStore(object):
+    """ usage: KeyStore(path, parameters=PARAMETERS, tag=None, id_size=16,
+                        writable=False) => store
+
+        Opens the store at path. A writable store is created if it does not
+        exist; tag is then serialization.PUBLIC_KEY for KEM public keys or
+        serialization.SIGNATURE_PUBLIC_KEY for signature public keys.
+
+        store[key_id] => KeyView; key_id in store; len(store); store.ids() """
+
+    def __init__(self, path, parameters=PARAMETERS, tag=None, id_size=16,
+                 writable=False):
+        self.path = path
+        self.index_path = path + ".index"
+        self.parameters = parameters
+        self.writable = writable
+        self._data = self._index = None
+        if writable and not os.path.exists(path):
+            if tag not in (serialization.PUBLIC_KEY,
+                           serialization.SIGNATURE_PUBLIC_KEY):
+                raise ValueError("A public key tag is required to create a store")
+            with self._locked():
+                self._write_files(tag, id_size, [], random_bytes(8))
+        self.refresh()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.close()
+
+    def close(self):
+        for mapping in (self._data, self._index):
+            if mapping is not None:
+                unmap_file(*mapping)
+        self._data = self._index = None
+
+    def refresh(self, attempts=8):
+        """ Maps the current files, picking up appends and compactions. """
+        for attempt in range(attempts):
+            self.close()
+            self._data = map_file(self.path)
+            self._index = map_file(self.index_path)
+            if self._read_headers():
+                return
+            # a writer is between renaming the two files
+            time.sleep(.01 * (attempt + 1))
+        raise ValueError("Store files have mismatched generations")
+
+    def _read_headers(self):
+        data = self._data[1]
+        if len(data) < _HEADER.size:
+            raise ValueError("Truncated store")
+        (magic, version, self.tag, self.id_size, element_size, count,
+         fingerprint, generation) = _HEADER.unpack(data[:_HEADER.size].tobytes())
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a crypto2 key store")
+        if fingerprint != parameters_fingerprint(self.parameters):
+            raise ValueError("Store was created with different parameters")
+        if (element_size != serialization.element_size(self.parameters['q']) or
+            count != serialization.element_count(self.tag, self.parameters['n'])):
+            raise ValueError("Store record layout does not match the parameters")
+        self.record_size = self.id_size + (count * element_size)
+        self.record_count = (len(data) - _HEADER.size) // self.record_size
+
+        index = self._index[1]
+        (magic, version, index_generation, self.entry_count,
+         covered) = _INDEX_HEADER.unpack(index[:_INDEX_HEADER.size].tobytes())
+        if magic != INDEX_MAGIC or version != VERSION:
+            raise ValueError("Not a crypto2 key store index")
+        if index_generation != generation:
+            return False
+        self.generation = generation
+        self.entry_size = self.id_size + _RECORD_NUMBER.size
+        self._entries = index[_INDEX_HEADER.size:]
+        # records appended after the index was last written
+        self._tail = {}
+        for record_number in range(covered, self.record_count):
+            self._tail[self._record_id(record_number)] = record_number
+        self._live = self.entry_count
+        for _id in self._tail:
+            position = self._search(_id)
+            if position == self.entry_count or self._entry_id(position) != _id:
+                self._live += 1
+        return True
+
+    def _record_id(self, record_number):
+        offset = _HEADER.size + (record_number * self.record_size)
+        return self._data[1][offset:offset + self.id_size].tobytes()
+
+    def _entry_id(self, position):
+        offset = position * self.entry_size
+        return self._entries[offset:offset + self.id_size].tobytes()
+
+    def _search(self, key_id):
+        # position of the first index entry with an id >= key_id
+        low, high = 0, self.entry_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry_id(middle) < key_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _record_number(self, key_id):
+        if key_id in self._tail:
+            return self._tail[key_id]
+        position = self._search(key_id)
+        if position < self.entry_count and self._entry_id(position) == key_id:
+            offset = (position * self.entry_size) + self.id_size
+            entry = self._entries[offset:offset + _RECORD_NUMBER.size].tobytes()
+            return _RECORD_NUMBER.unpack(entry)[0]
+        return None
+
+    def _check_id(self, key_id):
+        key_id = bytes(as_bytes(key_id))
+        if len(key_id) != self.id_size:
+            raise ValueError("Key ids are {} bytes".format(self.id_size))
+        return key_id
+
+    def get(self, key_id, default=None):
+        key_id = self._check_id(key_id)
+        record_number = self._record_number(key_id)
+        if record_number is None:
+            return default
+        offset = _HEADER.size + (record_number * self.record_size) + self.id_size
+        data = self._data[1][offset:offset + self.record_size - self.id_size]
+        return KeyView(key_id, data, self.tag == serialization.PUBLIC_KEY,
+                       self.parameters['q'])
+
+    def __getitem__(self, key_id):
+        view = self.get(key_id)
+        if view is None:
+            raise KeyError(key_id)
+        return view
+
+    def __contains__(self, key_id):
+        return self._record_number(self._check_id(key_id)) is not None
+
+    def __len__(self):
+        return self._live
+
+    def ids(self):
+        # live key ids in sorted order
+        tail = sorted(self._tail)
+        indexed = (self._entry_id(position) for position in
+                   range(self.entry_count))
+        position = 0
+        for key_id in indexed:
+            while position < len(tail) and tail[position] < key_id:
+                yield tail[position]
+                position += 1
+            if position < len(tail) and tail[position] == key_id:
+                position += 1
+            yield key_id
+        for key_id in tail[position:]:
+            yield key_id
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # serializes writers across processes; readers never lock
+        with open(self.path + ".lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _pack(self, public_key):
+        entries = list(public_key)
+        if self.tag == serialization.PUBLIC_KEY:
+            entries = [element for entry in entries for element in entry]
+        count = (self.record_size - self.id_size) // serialization.element_size(
+                                                         self.parameters['q'])
+        if len(entries) != count:
+            raise ValueError("Expected {} elements, got {}".format(count,
+                                                                   len(entries)))
+        return serialization.pack_elements(entries, self.parameters['q'])
+
+    def append_many(self, items):
+        """ usage: store.append_many(items)
+
+            items is an iterable of (key_id, public_key). A key id that is
+            already present is superseded by the new record. """
+        if not self.writable:
+            raise ValueError("Store is read-only")
+        with self._locked():
+            self.refresh()
+            records = []
+            new = {}
+            record_number = self.record_count
+            for _id, public_key in items:
+                _id = self._check_id(_id)
+                records.append(_id + self._pack(public_key))
+                new[_id] = record_number
+                record_number += 1
+            new.update(dict((_id, number) for _id, number in self._tail.items()
+                            if _id not in new))
+            with open(self.path, "r+b") as _file:
+                # drop a partial record left by an interrupted append
+                end = _HEADER.size + (self.record_count * self.record_size)
+                _file.truncate(end)
+                _file.seek(end)
+                _file.write(b''.join(records))
+            self._merge_index(sorted(new.items()), record_number)
+            self.refresh()
+
+    def append(self, _id, public_key):
+        self.append_many([(_id, public_key)])
+
+    def delete_many(self, ids):
+        """ usage: store.delete_many(ids)
+
+            Removes ids from the index; their records are dropped by the next
+            compact(). """
+        if not self.writable:
+            raise ValueError("Store is read-only")
+        with self._locked():
+            self.refresh()
+            ids = set(self._check_id(_id) for _id in ids)
+            changes = sorted((_id, number) for _id, number in self._tail.items()
+                             if _id not in ids)
+            changes.extend((_id, None) for _id in ids)
+            changes.sort(key=lambda change: change[0])
+            self._merge_index(changes, self.record_count)
+            self.refresh()
+
+    def _merge_index(self, changes, covered):
+        # changes: sorted (key id, record number or None to delete); the
+        # unchanged runs of the old index are copied over in bulk
+        entry_size = self.entry_size
+        output = []
+        count = 0
+        position = 0
+        for _id, record_number in changes:
+            found = self._search(_id)
+            output.append(self._entries[position * entry_size:
+                                        found * entry_size].tobytes())
+            count += found - position
+            position = found
+            if position < self.entry_count and self._entry_id(position) == _id:
+                position += 1
+            if record_number is not None:
+                output.append(_id + _RECORD_NUMBER.pack(record_number))
+                count += 1
+        output.append(self._entries[position * entry_size:
+                                    self.entry_count * entry_size].tobytes())
+        count += self.entry_count - position
+        header = _INDEX_HEADER.pack(INDEX_MAGIC, VERSION, self.generation,
+                                    count, covered)
+        self._replace(self.index_path, [header] + output)
+
+    def _replace(self, path, chunks):
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as _file:
+            for chunk in chunks:
+                _file.write(chunk)
+            _file.flush()
+            os.fsync(_file.fileno())
+        _rename(temporary, path)
+
+    def _write_files(self, tag, id_size, records, generation):
+        # records: iterable of (key id, packed elements) in key id order,
+        # streamed into both files; the data file is renamed into place first
+        q, n = self.parameters['q'], self.parameters['n']
+        header = _HEADER.pack(MAGIC, VERSION, tag, id_size,
+                              serialization.element_size(q),
+                              serialization.element_count(tag, n),
+                              parameters_fingerprint(self.parameters), generation)
+        paths = (self.path, self.index_path)
+        files = [open(path + ".tmp", "wb") for path in paths]
+        try:
+            data_file, index_file = files
+            data_file.write(header)
+            index_file.write(b"\0" * _INDEX_HEADER.size)
+            count = 0
+            for _id, data in records:
+                data_file.write(_id + data)
+                index_file.write(_id + _RECORD_NUMBER.pack(count))
+                count += 1
+            index_file.seek(0)
+            index_file.write(_INDEX_HEADER.pack(INDEX_MAGIC, VERSION, generation,
+                                                count, count))
+            for _file in files:
+                _file.flush()
+                os.fsync(_file.fileno())
+        finally:
+            for _file in files:
+                _file.close()
+        for path in paths:
+            _rename(path + ".tmp", path)
+
+    def compact(self):
+        """ Rewrites the store with only the live records, in key id order. """
+        if not self.writable:
+            raise ValueError("Store is read-only")
+        with self._locked():
+            self.refresh()
+            records = ((_id, self[_id].data.tobytes()) for _id in self.ids())
+            generation = random_bytes(8)
+            while generation == self.generation:
+                generation = random_bytes(8)
+            self._write_files(self.tag, self.id_size, records, generation)
+            self.refresh()
+
+def test_keystore():
+    import shutil
+    import tempfile
+    import kem
+    import signature
+    print("Testing keystore.py...")
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "kem.keys")
+        keypairs = [kem.generate_keypair() for count in range(6)]
+        ids = [key_id(public) for public, private in keypairs]
+        with KeyStore(path, tag=serialization.PUBLIC_KEY, writable=True) as store:
+            store.append_many(zip(ids[:4], [public for public, private in
+                                            keypairs[:4]]))
+            reader = KeyStore(path)
+            assert len(reader) == 4 and ids[4] not in reader
+            store.append_many(zip(ids[4:], [public for public, private in
+                                            keypairs[4:]]))
+            store.append(ids[0], keypairs[1][0])
+            store.delete_many([ids[2]])
+            assert len(reader) == 4
+            reader.refresh()
+            assert len(store) == len(reader) == 5 and ids[2] not in reader
+            assert list(reader.ids()) == sorted(set(ids) - set([ids[2]]))
+            for index in (1, 3, 4, 5):
+                public, private = keypairs[index]
+                view = reader[ids[index]]
+                assert view == public and len(view) == len(public)
+                assert [view[i] for i in range(len(view))] == list(public)
+                assert view[-1] == public[-1] and view[1:3] == list(public[1:3])
+                secret, cryptogram = kem.encapsulate_secret(view)
+                assert kem.recover_secret(private, cryptogram) == secret
+            assert reader[ids[0]] == keypairs[1][0]
+            size = os.path.getsize(path)
+            store.compact()
+            assert os.path.getsize(path) < size
+            assert list(KeyStore(path).ids()) == list(reader.ids())
+            reader.refresh()
+            assert reader[ids[5]] == keypairs[5][0]
+            reader.close()
+            try:
+                store.append(ids[0][:-1], keypairs[0][0])
+            except ValueError:
+                pass
+            else:
+                raise AssertionError("Accepted a short key id")
+
+        path = os.path.join(directory, "signature.keys")
+        public, private = signature.generate_keypair()
+        with KeyStore(path, tag=serialization.SIGNATURE_PUBLIC_KEY,
+                      writable=True) as store:
+            store.append(b"device-000000001", public)
+            signed = signature.sign(private, "message")
+            view = store[b"device-000000001"]
+            assert signature.verify(view, "message", signed)
+            assert view[0] == public[0] and view[-1] == public[-1]
+            try:
+                view[len(public)]
+            except IndexError:
+                pass
+            else:
+                raise AssertionError("Indexed past the end of a key")
+            assert store.get(b"device-000000002") is None
+    finally:
+        shutil.rmtree(directory)
+    print("Key store test complete")
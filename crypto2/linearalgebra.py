@@ -1,14 +1,107 @@
+import backend
+import core
+
 def dotproduct(v1, v2):
     return sum(v1[i] * v2i for i, v2i in enumerate(v2))
 
 def mmul(m, v, dot=dotproduct):
-    try:
-        return [dot(row, v) for row in m]
-    except (OverflowError, TypeError):
-        return [[dot(row, _v) for row in m] for _v in v]
+    # matrix times vector
+    return [dot(row, v) for row in m]
+
+def mmul_many(m, vectors, dot=dotproduct):
+    # [mmul(m, v) for v in vectors]
+    return [[dot(row, v) for row in m] for v in vectors]
 
 def scale_vector(v, s, q):
-    return [(x * s) % q for x in v]
+    return backend.scale_vector(v, s, q)
 
 def add_vector(v1, v2, q):
-    return [(v1[i] + v2[i]) % q for i in range(len(v1))]
+    return backend.add_vector(v1, v2, q)
+
+class Matrix(object):
+    """ usage: Matrix(rows, q) => matrix
+
+        A matrix over Z_q stored as a tuple of row tuples. Every entry of a
+        product is one backend.dotproduct, reduced once. """
+
+    __slots__ = ("rows", "q", "_columns")
+
+    def __init__(self, rows, q):
+        self.rows = tuple(tuple(row) for row in rows)
+        self.q = q
+        self._columns = None
+
+    @property
+    def shape(self):
+        return len(self.rows), len(self.rows[0]) if self.rows else 0
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = tuple(zip(*self.rows))
+        return self._columns
+
+    def transpose(self):
+        return Matrix(self.columns, self.q)
+
+    def __eq__(self, other):
+        return (isinstance(other, Matrix) and self.q == other.q and
+                self.rows == other.rows)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def multiply_vector(self, v):
+        # [row . v mod q for row in rows]
+        q = self.q
+        dot = backend.dotproduct
+        return [dot(row, v, q) for row in self.rows]
+
+    def multiply(self, other, block_size=32):
+        """ usage: matrix.multiply(other, block_size=32) => Matrix
+
+            self (m x k) times other (k x p). Rows of self are taken
+            block_size at a time against every column of other, so a block
+            and the column it meets stay in cache together. """
+        if self.shape[1] != other.shape[0]:
+            raise ValueError("Cannot multiply {} by {}".format(self.shape,
+                                                                other.shape))
+        q = self.q
+        dot = backend.dotproduct
+        columns = other.columns
+        output = []
+        for start in range(0, len(self.rows), block_size):
+            block = self.rows[start:start + block_size]
+            products = [[dot(row, column, q) for row in block] for
+                        column in columns]
+            output.extend(zip(*products))
+        return Matrix(output, q)
+
+def power_matrix(xs, q, n):
+    # row i = x_i, x_i^2, ..., x_i^n mod q
+    return Matrix([core.powers(x, q, n) for x in xs], q)
+
+def test_matrix():
+    from utilities import random_vector_mod_q
+    print("Testing linearalgebra.py...")
+    q = (2 ** 61) - 1
+    a = Matrix([random_vector_mod_q(16, q, 5) for row in range(7)], q)
+    b = Matrix([random_vector_mod_q(16, q, 3) for row in range(5)], q)
+    expected = [[sum(a.rows[i][k] * b.rows[k][j] for k in range(5)) % q for
+                 j in range(3)] for i in range(7)]
+    for block_size in (1, 2, 32):
+        product = a.multiply(b, block_size)
+        assert product.shape == (7, 3)
+        assert [list(row) for row in product.rows] == expected
+    v = random_vector_mod_q(16, q, 5)
+    assert a.multiply_vector(v) == [x % q for x in mmul(a.rows, v)]
+    assert mmul_many(a.rows, [v, v]) == [mmul(a.rows, v)] * 2
+    assert a.transpose().transpose() == a
+    assert power_matrix([2, 3], q, 3).rows == ((2, 4, 8), (3, 9, 27))
+    try:
+        a.multiply(a)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Multiplied mismatched shapes")
+    print("Matrix test complete")
@@ -0,0 +1,145 @@
+""" Process-pool execution of bulk keygen, signing, verification and aggregation.
+
+    Parameters are handed to every worker once, by the pool initializer, and
+    work is sent in chunks of chunk_size items to spread the pickling cost. """
+import multiprocessing
+
+import aggregate
+import kem
+import signature
+from parameters import PARAMETERS
+from utilities import slide
+
+_worker_parameters = None
+
+def _initialize(parameters):
+    global _worker_parameters
+    _worker_parameters = parameters
+
+def worker_parameters():
+    # the parameters given to this worker process by the pool initializer
+    return _worker_parameters
+
+def _generate_keypairs(job):
+    scheme, count = job
+    generate_keypair = KEYPAIR_GENERATORS[scheme]
+    return [generate_keypair(_worker_parameters) for index in range(count)]
+
+def _sign(job):
+    private_key, messages = job
+    private_key = signature.prepare_private_key(private_key, _worker_parameters)
+    return [signature.sign(private_key, message, _worker_parameters) for
+            message in messages]
+
+def _verify(items):
+    return signature.verify_batch(items, _worker_parameters)
+
+def _aggregate(ciphertexts):
+    return aggregate.Accumulator(_worker_parameters).add_many(ciphertexts).result()
+
+KEYPAIR_GENERATORS = {"signature" : signature.generate_keypair,
+                      "kem" : kem.generate_keypair}
+
+class Executor(object):
+    """ usage: Executor(parameters=PARAMETERS, processes=None,
+                        chunk_size=64) => executor
+
+        A pool of worker processes that share one set of parameters.
+        processes defaults to the number of cpus. Use as a context manager
+        or call close() when done. """
+
+    def __init__(self, parameters=PARAMETERS, processes=None, chunk_size=64):
+        self.parameters = parameters
+        self.chunk_size = chunk_size
+        self.pool = multiprocessing.Pool(processes, _initialize, (parameters, ))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def _map(self, function, jobs):
+        output = []
+        for result in self.pool.imap(function, jobs):
+            output.extend(result)
+        return output
+
+    def map(self, function, jobs):
+        """ usage: executor.map(function, jobs) => [function(job), ...]
+
+            function must be a module-level function; it can read the
+            parameters with worker_parameters(). """
+        return self.pool.map(function, jobs)
+
+    def generate_keypairs(self, count, scheme="signature"):
+        """ usage: executor.generate_keypairs(count,
+                                              scheme="signature") => [(public, private), ...]
+
+            scheme is "signature" or "kem". """
+        if scheme not in KEYPAIR_GENERATORS:
+            raise ValueError("Unknown scheme '{}'".format(scheme))
+        sizes = [self.chunk_size] * (count // self.chunk_size)
+        if count % self.chunk_size:
+            sizes.append(count % self.chunk_size)
+        return self._map(_generate_keypairs, [(scheme, size) for size in sizes])
+
+    def map_sign(self, private_key, messages):
+        """ usage: executor.map_sign(private_key, messages) => [signature, ...] """
+        messages = list(messages)
+        return self._map(_sign, [(private_key, chunk) for chunk in
+                                 slide(messages, self.chunk_size)])
+
+    def map_verify(self, items):
+        """ usage: executor.map_verify(items) => [bool, ...]
+
+            items is an iterable of (public_key, message, signature); each
+            chunk is checked with signature.verify_batch. """
+        return self._map(_verify, slide(list(items), self.chunk_size))
+
+    def aggregate(self, ciphertexts):
+        """ usage: executor.aggregate(ciphertexts) => ciphertext
+
+            Sums an iterable of ciphertexts in chunk_size shards across the
+            workers and merges the partial sums. """
+        accumulator = aggregate.Accumulator(self.parameters)
+        shards = aggregate.chunks(ciphertexts, self.chunk_size)
+        for partial in self.pool.imap_unordered(_aggregate, shards):
+            accumulator.add(partial)
+        return accumulator.result()
+
+def generate_keypairs(count, scheme="signature", parameters=PARAMETERS,
+                      processes=None, chunk_size=64):
+    with Executor(parameters, processes, chunk_size) as executor:
+        return executor.generate_keypairs(count, scheme)
+
+def map_sign(private_key, messages, parameters=PARAMETERS, processes=None,
+             chunk_size=64):
+    with Executor(parameters, processes, chunk_size) as executor:
+        return executor.map_sign(private_key, messages)
+
+def map_verify(items, parameters=PARAMETERS, processes=None, chunk_size=64):
+    with Executor(parameters, processes, chunk_size) as executor:
+        return executor.map_verify(items)
+
+def test_parallel():
+    print("Testing parallel.py...")
+    with Executor(processes=2, chunk_size=3) as executor:
+        keypairs = executor.generate_keypairs(7)
+        assert len(keypairs) == 7
+        assert len(executor.generate_keypairs(2, "kem")) == 2
+        public, private = keypairs[0]
+        messages = ["message {}".format(count) for count in range(8)]
+        signatures = executor.map_sign(private, messages)
+        items = [(public, message, signed) for message, signed in
+                 zip(messages, signatures)]
+        items[4] = (keypairs[1][0], items[4][1], items[4][2])
+        expected = [True] * len(items)
+        expected[4] = False
+        assert executor.map_verify(items) == expected
+        assert executor.map_verify([]) == []
+    print("Parallel test complete")
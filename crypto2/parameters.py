@@ -1,6 +1,35 @@
-from utilities import is_prime, compressible_vector
+import binascii
+import json
+import os
+import tempfile
 
-__all__ = ['Q', 'N', "R_SIZE", 'G', "PARAMETERS"]
+import backend
+import instrumentation
+from utilities import is_prime, decompress, expand_to_scalars, random_bytes
+
+__all__ = ['Q', 'N', "R_SIZE", 'G', "PARAMETERS", "PARAMETER_SETS",
+           "DEFAULT_PARAMETER_SET", "get_parameters", "save_parameters",
+           "load_parameters", "PreparedParameters", "prepare_parameters"]
+
+DEFAULT_PARAMETER_SET = "crypto2-128"
+
+# q = the first prime after 2 ** q_size (precomputed with generate_q)
+# G is derived from the seed, so every process agrees on it
+PARAMETER_SETS = {"crypto2-128" : {"security_level" : 128, "q_size" : 256,
+                                   'q' : (2 ** 256) + 297, 'n' : 23,
+                                   "seed" : "crypto2-128"},
+                  "crypto2-192" : {"security_level" : 192, "q_size" : 384,
+                                   'q' : (2 ** 384) + 231, 'n' : 15,
+                                   "seed" : "crypto2-192"},
+                  "crypto2-256" : {"security_level" : 256, "q_size" : 512,
+                                   'q' : (2 ** 512) + 75, 'n' : 11,
+                                   "seed" : "crypto2-256"}}
+
+# atomically replaces the destination where python offers it
+_rename = getattr(os, "replace", os.rename)
+
+_CACHE = {}
+_PREPARED = {}
 
 def find_closest_prime(n):
     if n % 2:
@@ -16,24 +45,172 @@ def generate_q(q_size):
     offset = find_closest_prime(q_start)
     return q_start + offset
 
-def generate_parameters(security_level):
+def derive_generator(seed, r_size, q):
+    return expand_to_scalars("crypto2 generator", seed, 1, q, r_size)[0]
+
+def build_parameters(security_level, q_size, q, n, seed, name=None,
+                     hash_algorithm="SHA512"):
+    r_size = q_size + security_level    # in bytes; larger than q to reduce bias
+    s_max = 2 ** security_level
+    g = derive_generator(seed, r_size, q)
+    G = decompress(g, n, q)
+    return {"name" : name, "security_level" : security_level, 'q' : q, 'n' : n,
+            'G' : G, 'g' : g, "r_size" : r_size, "s_max" : s_max,
+            "q_size" : q_size, "hash_algorithm" : hash_algorithm,
+            "seed" : seed}
+
+def generate_parameters(security_level, name=None, budget=1500):
     print("Warning: secure parameterization for 'n' not established")
 
     # picks the largest n that will allow a signature to fit in 1 packet
-    budget = 1500 * 8        # MTU, amount of space available in a single packet
+    # budget: bytes available in a single packet (default: the Ethernet MTU)
+    # explore.py measures the trade-offs of other budgets and sizes
+    budget = budget * 8
     q_size = (security_level * 2)
     n = int(float(budget / 2) / q_size)
     q = generate_q(q_size)
     print("Using log2(q)=2^{}, n={} for k={}".format(q_size, n, security_level))
 
-    r_size = q_size + security_level    # in bytes; larger than q to reduce bias
-    s_max = 2 ** security_level
-    hash_algorithm = "SHA512"
-    G = compressible_vector(r_size, n, q)
-    g = G[0]
-    parameters = {"security_level" : 128, 'q' : q, 'n' : n, 'G' : G, 'g' : g,
-                  "r_size" : r_size, "s_max" : s_max, "q_size" : q_size,
-                  "hash_algorithm" : hash_algorithm}
+    seed = binascii.hexlify(random_bytes(32)).decode("ascii")
+    parameters = build_parameters(security_level, q_size, q, n, seed, name)
+    G, g = parameters['G'], parameters['g']
+    r_size, s_max = parameters["r_size"], parameters["s_max"]
     return q, n, r_size, s_max, G, parameters
 
-Q, N, R_SIZE, S_MAX, G, PARAMETERS = generate_parameters(128)
+class PreparedParameters(object):
+    """ usage: PreparedParameters(parameters) => prepared
+
+        Polynomial evaluation for verification. G = g, gg, ..., g^n is the
+        fixed-base table of g, so evaluate_at_g(c) = c . G needs n products
+        and a single reduction; evaluate(c, x) uses Horner's rule with
+        interleaved reduction for a base x that has no table. """
+
+    __slots__ = ("parameters", "q", "n", "g", "G")
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.q, self.n, self.g = parameters['q'], parameters['n'], parameters['g']
+        self.G = tuple(parameters['G'])
+
+    def evaluate_at_g(self, coefficients):
+        # sum(c_j * g^(j + 1)) mod q
+        return backend.dotproduct(self.G, coefficients, self.q)
+
+    def evaluate(self, coefficients, x):
+        # sum(c_j * x^(j + 1)) mod q: one multiply and reduction per coefficient
+        q = self.q
+        if instrumentation.enabled:
+            instrumentation.count(multiplications=len(coefficients),
+                                  reductions=len(coefficients))
+        output = 0
+        for coefficient in reversed(coefficients):
+            output = ((output + coefficient) * x) % q
+        return output
+
+def prepare_parameters(parameters):
+    """ usage: prepare_parameters(parameters) => PreparedParameters
+
+        Prepared once per parameter set and shared. """
+    key = (parameters['q'], parameters['n'], parameters['g'])
+    try:
+        return _PREPARED[key]
+    except KeyError:
+        prepared = _PREPARED[key] = PreparedParameters(parameters)
+        return prepared
+
+def get_parameters(name=DEFAULT_PARAMETER_SET):
+    """ usage: get_parameters(name=DEFAULT_PARAMETER_SET) => parameters
+
+        Returns the named precomputed parameter set.
+        Sets are built on first use and cached; no prime search is done. """
+    try:
+        return _CACHE[name]
+    except KeyError:
+        try:
+            spec = PARAMETER_SETS[name]
+        except KeyError:
+            raise ValueError("Unknown parameter set '{}'".format(name))
+        parameters = _CACHE[name] = build_parameters(name=name, **spec)
+        return parameters
+
+def save_parameters(parameters, filename):
+    """ usage: save_parameters(parameters, filename) => None
+
+        Writes the values needed to rebuild parameters to filename.
+        G is not stored; it is derived from the seed on load. The record is
+        written to a temporary file that is renamed over filename, so a
+        failed write leaves no partial file behind. """
+    fields = ("name", "security_level", "q_size", 'q', 'n', "seed",
+              "hash_algorithm")
+    record = dict((field, parameters[field]) for field in fields)
+    record['q'] = str(record['q'])
+    directory = os.path.dirname(os.path.abspath(filename))
+    handle, temporary = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(handle, 'w') as _file:
+            json.dump(record, _file, indent=4, sort_keys=True)
+        _rename(temporary, filename)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+def load_parameters(filename):
+    """ usage: load_parameters(filename) => parameters
+
+        Rebuilds a parameter set written by save_parameters. """
+    with open(filename, 'r') as _file:
+        record = json.load(_file)
+    q = int(record['q'])
+    if not is_prime(q):
+        raise ValueError("Invalid parameters: q is not prime")
+    return build_parameters(int(record["security_level"]),
+                            int(record["q_size"]), q, int(record['n']),
+                            str(record["seed"]), record["name"] and str(record["name"]),
+                            str(record["hash_algorithm"]))
+
+PARAMETERS = get_parameters(DEFAULT_PARAMETER_SET)
+Q, N, R_SIZE, S_MAX, G = (PARAMETERS['q'], PARAMETERS['n'],
+                          PARAMETERS["r_size"], PARAMETERS["s_max"],
+                          PARAMETERS['G'])
+
+def test_parameters():
+    print("Testing parameter sets...")
+    for name, spec in PARAMETER_SETS.items():
+        parameters = get_parameters(name)
+        assert get_parameters(name) is parameters
+        assert parameters['q'] == generate_q(spec["q_size"])
+        assert parameters['G'] == decompress(parameters['g'], spec['n'],
+                                             spec['q'])
+        prepared = prepare_parameters(parameters)
+        assert prepare_parameters(parameters) is prepared
+        coefficients = list(range(1, spec['n'] + 1))
+        assert (prepared.evaluate(coefficients, parameters['g']) ==
+                prepared.evaluate_at_g(coefficients) ==
+                sum(c * x for c, x in zip(coefficients, parameters['G'])) % spec['q'])
+
+    handle, filename = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        save_parameters(PARAMETERS, filename)
+        _parameters = load_parameters(filename)
+    finally:
+        os.remove(filename)
+    assert _parameters == PARAMETERS
+
+    generated = generate_parameters(64, "generated")[-1]
+    handle, filename = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        save_parameters(generated, filename)
+        _generated = load_parameters(filename)
+    finally:
+        os.remove(filename)
+    assert _generated == generated
+    print("Parameter set test complete")
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) != 3:
+        raise SystemExit("usage: parameters.py security_level filename")
+    parameters = generate_parameters(int(sys.argv[1]))[-1]
+    save_parameters(parameters, sys.argv[2])
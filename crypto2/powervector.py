@@ -0,0 +1,178 @@
+""" Permuted power vectors S' = PS, as proposed in outline.md.
+
+    S = s, ss, ..., s^n mod q is shuffled by a permutation P. The vector is
+    stored as the scalar s and the Lehmer code rank of P, which is packed
+    into log2(n!) + log2(q) bits instead of the n * log2(q) bits of the
+    uncompressed vector.
+
+    A PowerVector is a read-only sequence of its n entries, so it can be
+    passed to core and backend arithmetic wherever a vector is expected; the
+    entries are decompressed once, on first use. """
+import bisect
+
+import core
+import serialization
+from parameters import PARAMETERS
+from utilities import find_generator, random_integer_mod_q
+
+def factorial(n):
+    output = 1
+    for k in range(2, n + 1):
+        output *= k
+    return output
+
+def rank_permutation(permutation):
+    """ usage: rank_permutation(permutation) => rank
+
+        Returns the Lehmer code of a permutation of range(n) read as a mixed
+        radix number, 0 <= rank < n!. """
+    n = len(permutation)
+    unused = list(range(n))
+    rank = 0
+    for i, value in enumerate(permutation):
+        # the digit counts the unused values smaller than value
+        digit = bisect.bisect_left(unused, value)
+        if digit == len(unused) or unused[digit] != value:
+            raise ValueError("Not a permutation of range({})".format(n))
+        del unused[digit]
+        rank = (rank * (n - i)) + digit
+    return rank
+
+def unrank_permutation(rank, n):
+    """ usage: unrank_permutation(rank, n) => permutation
+
+        Inverse of rank_permutation. """
+    digits = [0] * n
+    for i in range(n - 1, -1, -1):
+        rank, digits[i] = divmod(rank, n - i)
+    if rank:
+        raise ValueError("Rank out of range for n = {}".format(n))
+    unused = list(range(n))
+    return [unused.pop(digit) for digit in digits]
+
+class PowerVector(object):
+    """ usage: PowerVector(scalar, rank, q, n) => vector
+
+        The vector with entry i equal to scalar^(permutation[i] + 1) mod q,
+        where permutation = unrank_permutation(rank, n). """
+
+    __slots__ = ("scalar", "rank", "q", "n", "_entries")
+
+    def __init__(self, scalar, rank, q, n):
+        self.scalar = scalar
+        self.rank = rank
+        self.q = q
+        self.n = n
+        self._entries = None
+
+    def permutation(self):
+        return unrank_permutation(self.rank, self.n)
+
+    def decompress(self):
+        # n multiplications for the powers, then one pass to place them
+        if self._entries is None:
+            powers = core.powers(self.scalar, self.q, self.n)
+            self._entries = [powers[index] for index in self.permutation()]
+        return self._entries
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return iter(self.decompress())
+
+    def __getitem__(self, index):
+        return self.decompress()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, PowerVector):
+            return ((self.scalar, self.rank, self.q, self.n) ==
+                    (other.scalar, other.rank, other.q, other.n))
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "PowerVector({}, {}, {}, {})".format(self.scalar, self.rank,
+                                                    self.q, self.n)
+
+def random_power_vector(parameters=PARAMETERS):
+    q, n = parameters['q'], parameters['n']
+    orderings = factorial(n)
+    scalar = random_integer_mod_q(parameters["r_size"], q)
+    # 16 extra bytes make the bias of the reduced rank negligible
+    size = ((orderings.bit_length() + 7) // 8) + 16
+    return PowerVector(scalar, random_integer_mod_q(size, orderings), q, n)
+
+def compress_vector(vector, q):
+    """ usage: compress_vector(vector, q) => PowerVector
+
+        vector is a list holding a permutation of s, ss, ..., s^n mod q. """
+    scalar, permutation = find_generator(vector, q)
+    return PowerVector(scalar, rank_permutation(permutation), q, len(vector))
+
+def compressed_size(q, n):
+    # bytes needed for rank * q + scalar, which is below n! * q
+    return (((factorial(n) * q) - 1).bit_length() + 7) // 8
+
+def serialize_power_vector(vector, parameters=PARAMETERS):
+    q, n = parameters['q'], parameters['n']
+    if (vector.q, vector.n) != (q, n):
+        raise ValueError("Vector does not match the parameters")
+    return serialization.encode_integer(serialization.POWER_VECTOR,
+                                        (vector.rank * q) + vector.scalar,
+                                        compressed_size(q, n))
+
+def deserialize_power_vector(data, parameters=PARAMETERS):
+    q, n = parameters['q'], parameters['n']
+    value = serialization.decode_integer(data, serialization.POWER_VECTOR,
+                                         compressed_size(q, n))
+    rank, scalar = divmod(value, q)
+    if rank >= factorial(n):
+        raise ValueError("Rank out of range for n = {}".format(n))
+    return PowerVector(scalar, rank, q, n)
+
+def test_power_vector():
+    import itertools
+    import backend
+    from utilities import random_vector_mod_q
+    print("Testing powervector.py...")
+    for n in range(1, 6):
+        permutations = list(itertools.permutations(range(n)))
+        ranks = [rank_permutation(list(permutation)) for permutation in permutations]
+        assert ranks == list(range(factorial(n)))
+        assert [tuple(unrank_permutation(rank, n)) for rank in ranks] == permutations
+    for bad in ([0, 0], [1, 2]):
+        try:
+            rank_permutation(bad)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Ranked {}".format(bad))
+
+    q, n = PARAMETERS['q'], PARAMETERS['n']
+    vector = random_power_vector()
+    entries = list(vector)
+    assert sorted(entries) == sorted(core.powers(vector.scalar, q, n))
+    assert compress_vector(entries, q) == vector
+    identity = PowerVector(PARAMETERS['g'], 0, q, n)
+    assert identity == PARAMETERS['G']
+    assert compress_vector(PARAMETERS['G'], q) == identity
+    other = random_vector_mod_q(PARAMETERS["r_size"], q, n)
+    assert (backend.dotproduct(vector, other, q) ==
+            backend.dotproduct(entries, other, q))
+
+    data = serialize_power_vector(vector)
+    assert len(data) == 2 + compressed_size(q, n) < 2 + (n * serialization.element_size(q))
+    assert deserialize_power_vector(data) == vector
+    for bad_data in (data[:-1], serialization.encode_integer(
+                     serialization.POWER_VECTOR, (factorial(n) * q),
+                     compressed_size(q, n))):
+        try:
+            deserialize_power_vector(bad_data)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Accepted invalid encoding")
+    print("Power vector test complete")
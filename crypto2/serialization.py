@@ -0,0 +1,170 @@
+""" Versioned fixed-width binary encoding for keys, ciphertexts and signatures.
+
+    Layout: version (1 byte) | type tag (1 byte) | elements
+    Every element of Z_q is a big-endian integer of element_size(q) bytes, so
+    the length of an encoding is fixed by its type and the parameters; the
+    one exception is SEED_SUM, which holds between 1 and n seeds.
+    POWER_VECTOR is not made of elements: it holds a single integer packed
+    into the smallest whole number of bytes (see encode_integer). """
+import binascii
+import struct
+
+VERSION = 1
+
+# type tags
+KEY = 1
+COMPRESSED_CIPHERTEXT = 2
+CIPHERTEXT = 3
+PUBLIC_KEY = 4
+SIGNATURE = 5
+SIGNATURE_PUBLIC_KEY = 6
+SEED_SUM = 7
+POWER_VECTOR = 8
+
+_HEADER = struct.Struct(">BB")
+
+def element_size(q):
+    return (q.bit_length() + 7) // 8
+
+def element_count(tag, n):
+    # number of Z_q elements that follow the header for `tag`
+    # SEED_SUM is variable-length and returns the (minimum, maximum) count
+    if tag == SEED_SUM:
+        return 2, n + 1
+    elif tag in (KEY, COMPRESSED_CIPHERTEXT):
+        return 2
+    elif tag == CIPHERTEXT:
+        return n + 1
+    elif tag in (PUBLIC_KEY, SIGNATURE):
+        return 2 * n
+    elif tag == SIGNATURE_PUBLIC_KEY:
+        return n
+    raise ValueError("Unknown type tag {}".format(tag))
+
+def _check_count(tag, count, n):
+    expected = element_count(tag, n)
+    if isinstance(expected, tuple):
+        if not expected[0] <= count <= expected[1]:
+            raise ValueError("Expected {} to {} elements, got {}".format(
+                             expected[0], expected[1], count))
+    elif count != expected:
+        raise ValueError("Expected {} elements, got {}".format(expected, count))
+
+def encoded_size(tag, parameters, count=None):
+    # count is required for variable-length tags
+    if count is None:
+        count = element_count(tag, parameters['n'])
+    return _HEADER.size + (count * element_size(parameters['q']))
+
+def _check_reduced(elements, q):
+    if elements and (min(elements) < 0 or max(elements) >= q):
+        raise ValueError("Element not reduced mod q")
+
+if hasattr(int, "from_bytes"):
+    def _pack(elements, size):
+        return b''.join([element.to_bytes(size, "big") for element in elements])
+
+    def _unpack(view, size):
+        # decodes straight from slices of the view; the buffer is not copied
+        from_bytes = int.from_bytes
+        return [from_bytes(view[index:index + size], "big") for index in
+                range(0, len(view), size)]
+else:
+    def _pack(elements, size):
+        return binascii.unhexlify(("%0{}x".format(2 * size) * len(elements)) %
+                                  tuple(elements))
+
+    def _unpack(view, size):
+        hexed = binascii.hexlify(view)
+        width = 2 * size
+        return [int(hexed[index:index + width], 16) for index in
+                range(0, len(hexed), width)]
+
+def pack_elements(elements, q):
+    # concatenated fixed-width encodings of elements, without a header
+    elements = list(elements)
+    _check_reduced(elements, q)
+    return _pack(elements, element_size(q))
+
+def unpack_elements(data, q):
+    # inverse of pack_elements; data must hold a whole number of elements
+    view = memoryview(data)
+    if len(view) % element_size(q):
+        raise ValueError("Invalid length {}".format(len(view)))
+    elements = _unpack(view, element_size(q))
+    _check_reduced(elements, q)
+    return elements
+
+def encode(tag, elements, parameters):
+    elements = list(elements)
+    _check_count(tag, len(elements), parameters['n'])
+    return _HEADER.pack(VERSION, tag) + pack_elements(elements, parameters['q'])
+
+def encode_integer(tag, value, size):
+    # header followed by value as a size-byte big-endian integer
+    if not 0 <= value < 2 ** (8 * size):
+        raise ValueError("Integer does not fit in {} bytes".format(size))
+    body = binascii.unhexlify("%0{}x".format(2 * size) % value) if size else b''
+    return _HEADER.pack(VERSION, tag) + body
+
+def decode_integer(data, tag, size):
+    # inverse of encode_integer
+    view = memoryview(data)
+    if read_tag(view) != tag:
+        raise ValueError("Unexpected type tag {}".format(read_tag(view)))
+    if len(view) != _HEADER.size + size:
+        raise ValueError("Invalid length {} for type tag {}".format(len(view), tag))
+    body = view[_HEADER.size:]
+    return int(binascii.hexlify(body), 16) if size else 0
+
+def read_tag(data):
+    view = memoryview(data)
+    if len(view) < _HEADER.size:
+        raise ValueError("Truncated data")
+    version, tag = _HEADER.unpack_from(view, 0)
+    if version != VERSION:
+        raise ValueError("Unsupported version {}".format(version))
+    return tag
+
+def decode(data, tags, parameters):
+    """ usage: decode(data, tags, parameters) => tag, elements
+
+        Decodes data produced by encode, which must carry one of tags.
+        The length is checked before any element is parsed. """
+    view = memoryview(data)
+    tag = read_tag(view)
+    if tag not in tags:
+        raise ValueError("Unexpected type tag {}".format(tag))
+    q = parameters['q']
+    size = element_size(q)
+    count, remainder = divmod(len(view) - _HEADER.size, size)
+    if remainder:
+        raise ValueError("Invalid length {} for type tag {}".format(len(view), tag))
+    _check_count(tag, count, parameters['n'])
+    return tag, unpack_elements(view[_HEADER.size:], q)
+
+def test_encode_decode():
+    from parameters import PARAMETERS
+    print("Testing serialization.py encoding...")
+    q, n = PARAMETERS['q'], PARAMETERS['n']
+    elements = [0, 1, q - 1] + list(range(2 * n - 3))
+    data = encode(PUBLIC_KEY, elements, PARAMETERS)
+    size = element_size(q)
+    assert len(data) == 2 + (2 * n * element_size(q))
+    assert decode(data, (PUBLIC_KEY, ), PARAMETERS) == (PUBLIC_KEY, elements)
+    assert decode(bytearray(data), (PUBLIC_KEY, ), PARAMETERS)[1] == elements
+    seeds = encode(SEED_SUM, elements[:3], PARAMETERS)
+    assert decode(seeds, (SEED_SUM, ), PARAMETERS) == (SEED_SUM, elements[:3])
+    for bad_data, tags in ((encode(SEED_SUM, elements[:2], PARAMETERS)[:-size],
+                            (SEED_SUM, )),
+                           (data[:-1], (PUBLIC_KEY, )),
+                           (data + data[-1:], (PUBLIC_KEY, )),
+                           (data, (SIGNATURE, )),
+                           (data[:1], (PUBLIC_KEY, ))):
+        try:
+            decode(bad_data, tags, PARAMETERS)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Accepted invalid encoding")
+    print("Encoding test complete")
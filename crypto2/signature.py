@@ -1,17 +1,26 @@
+import collections
 import hashlib
+import mmap
+import operator
+import threading
 
+import backend
 import core
-from parameters import PARAMETERS
-from utilities import bytes_to_integer, random_integer_mod_q
+import instrumentation
+import linearalgebra
+import serialization
+from parameters import PARAMETERS, prepare_parameters
+from utilities import as_bytes, bytes_to_integer, random_vector_mod_q
 
 def generate_private_key(parameters=PARAMETERS):
     r_size, q = parameters["r_size"], parameters['q']
-    return [random_integer_mod_q(r_size, q) for count in range(parameters['n'])]
+    return random_vector_mod_q(r_size, q, parameters['n'])
 
 def generate_public_key(private_key, parameters=PARAMETERS):
     g, q, n = parameters["g"], parameters['q'], parameters['n']
-    return [core.f(g, key_scalar, q, n) for key_scalar in private_key]
+    return core.f_many(g, private_key, q, n)
 
+@instrumentation.operation("signature.keygen")
 def generate_keypair(parameters=PARAMETERS):
     private_key = generate_private_key(parameters)
     public_key = generate_public_key(private_key, parameters)
@@ -20,53 +29,412 @@ def generate_keypair(parameters=PARAMETERS):
         raise SystemExit("Generated insecure public key")
     return public_key, private_key
 
+CHUNK_SIZE = 1024 * 1024
+CHALLENGE_CACHE_SIZE = 1024
+
+try:
+    _path_types = (basestring, )
+except NameError:
+    _path_types = (str, )
+
+def new_hash(m=b'', parameters=PARAMETERS):
+    """ usage: new_hash(m=b'', parameters=PARAMETERS) => hash object
+
+        An incremental hash object for the parameters' hash algorithm;
+        update it with the message and pass it to sign_stream/verify_stream. """
+    if instrumentation.enabled:
+        instrumentation.count(hash_calls=1)
+    hasher = getattr(hashlib, parameters["hash_algorithm"].lower())()
+    if m:
+        hasher.update(as_bytes(m))
+    return hasher
+
+def hash_message(source, parameters=PARAMETERS, chunk_size=CHUNK_SIZE):
+    """ usage: hash_message(source, parameters=PARAMETERS,
+                            chunk_size=CHUNK_SIZE) => digest
+
+        source is an incremental hash object, a file path, an open binary
+        file, or a buffer such as an mmap; files and buffers are hashed
+        chunk_size bytes at a time. """
+    if hasattr(source, "digest"):
+        return source.digest()
+    hasher = new_hash(parameters=parameters)
+    if isinstance(source, _path_types):
+        with open(source, "rb") as _file:
+            _hash_file(hasher, _file, chunk_size)
+    elif hasattr(source, "read") and not isinstance(source, mmap.mmap):
+        _hash_file(hasher, source, chunk_size)
+    else:
+        for index in range(0, len(source), chunk_size):
+            hasher.update(source[index:index + chunk_size])
+    return hasher.digest()
+
+def _hash_file(hasher, _file, chunk_size):
+    while True:
+        data = _file.read(chunk_size)
+        if not data:
+            return
+        hasher.update(data)
+
+def digest_to_scalar(digest, parameters=PARAMETERS):
+    # WARNING: ensure the digest is significantly larger than q to minimize bias
+    return bytes_to_integer(bytearray(digest)) % parameters['q']
+
 def hash_to_scalar(m, parameters=PARAMETERS):
-    q = parameters['q']
-    h = getattr(hashlib, parameters["hash_algorithm"].lower())
-    # WARNING: ensure h(m) is significantly larger than q to minimize bias
-    return bytes_to_integer(bytearray(h(m).digest())) % q
+    return digest_to_scalar(new_hash(m, parameters).digest(), parameters)
+
+class ChallengeCache(object):
+    """ usage: ChallengeCache(size=CHALLENGE_CACHE_SIZE) => cache
+
+        Least recently used map of (digest, q, n) to the challenge powers
+        s, ss, sss, ... so that a message verified against many keys is
+        only hashed to s and decompressed once. size=0 disables caching.
+
+        get always returns the powers. lookup returns None the first time a
+        digest is seen, as a one-off verification is cheaper with Horner's
+        rule than with the powers; from the second time on it caches them. """
+
+    __slots__ = ("size", "entries", "seen", "lock", "hits", "misses")
+
+    def __init__(self, size=CHALLENGE_CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.seen = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _find(self, key):
+        # called with the lock held
+        challenge = self.entries.pop(key, None)
+        if challenge is not None:
+            self.entries[key] = challenge
+            self.hits += 1
+        else:
+            self.misses += 1
+        return challenge
 
-def sign(private_key, m, parameters=PARAMETERS):
-    s = stemp = hash_to_scalar(m, parameters)
-    q = parameters['q']; n = parameters['n']
+    def _store(self, key, digest, parameters):
+        q, n = key[1], key[2]
+        challenge = tuple(core.powers(digest_to_scalar(digest, parameters), q, n))
+        if self.size:
+            with self.lock:
+                self.entries[key] = challenge
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return challenge
+
+    def get(self, digest, parameters=PARAMETERS):
+        key = (bytes(digest), parameters['q'], parameters['n'])
+        with self.lock:
+            challenge = self._find(key)
+        if challenge is None:
+            challenge = self._store(key, digest, parameters)
+        return challenge
+
+    def lookup(self, digest, parameters=PARAMETERS):
+        key = (bytes(digest), parameters['q'], parameters['n'])
+        with self.lock:
+            challenge = self._find(key)
+            if challenge is not None:
+                return challenge
+            if self.seen.pop(key, None) is None:
+                self.seen[key] = True
+                while len(self.seen) > self.size:
+                    self.seen.popitem(last=False)
+                return None
+        return self._store(key, digest, parameters)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.seen.clear()
+            self.hits = self.misses = 0
+
+challenge_cache = ChallengeCache()
+
+def challenge_powers(digest, parameters=PARAMETERS):
+    # s, ss, sss, ... for the message digest, through the shared cache
+    return challenge_cache.get(digest, parameters)
+
+def power_columns(scalars, q, n):
+    # columns[j] = [x^(j + 1) for x in scalars]
+    return linearalgebra.power_matrix(scalars, q, n).columns
+
+class PreparedPrivateKey(object):
+    """ A private key with the powers of each scalar decompressed once. """
+
+    __slots__ = ("private_key", "columns", "parameters")
+
+    def __init__(self, private_key, parameters=PARAMETERS):
+        self.private_key = private_key
+        self.columns = power_columns(private_key, parameters['q'], parameters['n'])
+        self.parameters = parameters
+
+def prepare_private_key(private_key, parameters=PARAMETERS):
+    if isinstance(private_key, PreparedPrivateKey):
+        return private_key
+    return PreparedPrivateKey(private_key, parameters)
+
+def generate_ephemeral_key(parameters=PARAMETERS):
+    # the second keypair used by sign, with its private key already decompressed
     pub2, priv2 = generate_keypair(parameters)
-    preimage = [0] * n
-    for i in range(n):
-        x, y = private_key[i], priv2[i]
-        xtemp, ytemp = x, y
-        for j in range(n):
-            preimage[j] = (preimage[j] + ((xtemp + ytemp) * stemp)) % q
-            xtemp = (xtemp * x) % q
-            ytemp = (ytemp * y) % q
-        #key_vector = core.decompress_and_add(private_key[i], priv2[i], q, n)
-        #preimage = core.add_vector(preimage,
-        #                           core.scale_vector(key_vector, stemp, q),
-        #                           q)
-        stemp = (s * stemp) % q
+    return pub2, power_columns(priv2, parameters['q'], parameters['n'])
+
+def generate_ephemeral_keys(count, parameters=PARAMETERS):
+    return [generate_ephemeral_key(parameters) for index in range(count)]
+
+@instrumentation.operation("signature.sign")
+def sign_digest(private_key, digest, parameters=PARAMETERS, pool=None):
+    """ usage: sign_digest(private_key, digest, parameters=PARAMETERS,
+                           pool=None) => signature
+
+        Signs a message that was already hashed with new_hash. """
+    # preimage[j] = sum(s^(i + 1) * (x_i^(j + 1) + y_i^(j + 1)) for i in range(n))
+    # = (x_j + y_j) . S: one backend dot product per coordinate, reduced once
+    # pool: optional keypool.EphemeralKeyPool to take the second keypair from
+    private_key = prepare_private_key(private_key, parameters)
+    q = parameters['q']
+    if pool is None:
+        pub2, ephemeral_columns = generate_ephemeral_key(parameters)
+    else:
+        pub2, ephemeral_columns = pool.get()
+    # computed directly: unique messages from a signer would otherwise evict
+    # the verification entries from the shared cache
+    weights = core.powers(digest_to_scalar(digest, parameters), q, parameters['n'])
+    dot, add = backend.dotproduct, operator.add
+    preimage = [dot(list(map(add, x_column, y_column)), weights, q) for
+                x_column, y_column in zip(private_key.columns, ephemeral_columns)]
     return preimage, pub2
 
-def verify(public_key, m, signature, parameters=PARAMETERS):
+@instrumentation.operation("signature.sign")
+def sign(private_key, m, parameters=PARAMETERS, pool=None):
+    return sign_digest(private_key, new_hash(m, parameters).digest(),
+                       parameters, pool)
+
+@instrumentation.operation("signature.sign")
+def sign_stream(private_key, source, parameters=PARAMETERS, pool=None):
+    """ usage: sign_stream(private_key, source, parameters=PARAMETERS,
+                           pool=None) => signature
+
+        source is anything hash_message accepts. The signature verifies
+        with verify against the full message as well. """
+    return sign_digest(private_key, hash_message(source, parameters),
+                       parameters, pool)
+
+def compute_verifier(public_key, pub2, s, parameters=PARAMETERS):
+    # pub_r . S, where pub_r = public_key + pub2 and S = s, ss, sss, ...
+    # evaluated with Horner's rule: one multiply and reduction per entry
+    pub_r = list(map(operator.add, public_key, pub2))
+    return prepare_parameters(parameters).evaluate(pub_r, s)
+
+def _verifier(public_key, pub2, digest, parameters):
+    # pub_r . S mod q: from the cached powers S for a digest seen before,
+    # otherwise with Horner's rule at s
+    challenge = challenge_cache.lookup(digest, parameters)
+    if challenge is None:
+        return compute_verifier(public_key, pub2,
+                                digest_to_scalar(digest, parameters), parameters)
+    return backend.dotproduct(list(map(operator.add, public_key, pub2)),
+                              challenge, parameters['q'])
+
+@instrumentation.operation("signature.verify")
+def verify_digest(public_key, digest, signature, parameters=PARAMETERS):
+    """ usage: verify_digest(public_key, digest, signature,
+                             parameters=PARAMETERS) => bool """
     # add public_key and pub2
     # compute pub_r . S
     # verify preimage . G == pub_r . S
-    n = parameters['n']; q = parameters['q']
-    s = stemp = hash_to_scalar(m, parameters)
+    n = parameters['n']
     preimage, pub2 = signature
+    if not len(public_key) == len(preimage) == len(pub2) == n:
+        return False
+    verifier = _verifier(public_key, pub2, digest, parameters)
 
-    verifier = 0
-    for i in range(n):
-        # add public_key and pub2
-        pub_r_i = (public_key[i] + pub2[i]) % q
-        # pub_r . S (at index i)
-        verifier = (verifier + (pub_r_i * stemp)) % q
-        # s, ss, sss, ssss, ...
-        stemp = (s * stemp) % q
-
-    if core.dotproduct(parameters['G'], preimage) % q == verifier % q:
+    if prepare_parameters(parameters).evaluate_at_g(preimage) == verifier:
         return True
     else:
         return False
 
+@instrumentation.operation("signature.verify")
+def verify(public_key, m, signature, parameters=PARAMETERS):
+    return verify_digest(public_key, new_hash(m, parameters).digest(),
+                         signature, parameters)
+
+@instrumentation.operation("signature.verify")
+def verify_stream(public_key, source, signature, parameters=PARAMETERS):
+    """ usage: verify_stream(public_key, source, signature,
+                             parameters=PARAMETERS) => bool
+
+        source is anything hash_message accepts. """
+    return verify_digest(public_key, hash_message(source, parameters),
+                         signature, parameters)
+
+def _well_formed(item, n):
+    public_key, m, (preimage, pub2) = item
+    return len(public_key) == len(preimage) == len(pub2) == n
+
+def _verify_combined(checks, parameters, weight_size):
+    # F is linear, so (sum(w_k * preimage_k)) . G == sum(w_k * verifier_k)
+    # holds for random weights w_k unless some signature is invalid; the
+    # weighted preimages are summed per coordinate (reduced once each) and
+    # G is evaluated once for the whole batch
+    q = parameters['q']
+    dot = backend.dotproduct
+    weights = [weight | 1 for weight in random_vector_mod_q(weight_size,
+                                                            2 ** (8 * weight_size),
+                                                            len(checks))]
+    combined = [dot(weights, column, q) for column in
+                zip(*[preimage for preimage, verifier in checks])]
+    right = dot(weights, [verifier for preimage, verifier in checks], q)
+    return prepare_parameters(parameters).evaluate_at_g(combined) == right
+
+def _verify_batch(checks, indices, parameters, weight_size, output):
+    if _verify_combined([checks[index] for index in indices], parameters,
+                        weight_size):
+        return
+    if len(indices) == 1:
+        output[indices[0]] = False
+        return
+    middle = len(indices) // 2
+    _verify_batch(checks, indices[:middle], parameters, weight_size, output)
+    _verify_batch(checks, indices[middle:], parameters, weight_size, output)
+
+@instrumentation.operation("signature.verify_batch")
+def verify_batch(items, parameters=PARAMETERS, weight_size=16):
+    """ usage: verify_batch(items, parameters=PARAMETERS,
+                            weight_size=16) => [bool, ...]
+
+        Verifies an iterable of (public_key, m, signature) triples at once.
+        The triples are combined with random weight_size-byte weights and
+        checked as one equation; if that fails, the batch is split in halves
+        until the invalid signatures are isolated. Each message is hashed
+        and its verifier computed once, however often it is rechecked.
+        Returns one boolean per item, in order. """
+    items = list(items)
+    if instrumentation.enabled:
+        instrumentation.count(items=len(items))
+    n = parameters['n']
+    output = [_well_formed(item, n) for item in items]
+    indices = [index for index, valid in enumerate(output) if valid]
+    checks = {}
+    for index in indices:
+        public_key, m, (preimage, pub2) = items[index]
+        digest = new_hash(m, parameters).digest()
+        checks[index] = (preimage, _verifier(public_key, pub2, digest, parameters))
+    if indices:
+        _verify_batch(checks, indices, parameters, weight_size, output)
+    return output
+
+def test_verify_batch():
+    print("Testing batch verification...")
+    items = []
+    for count in range(8):
+        public, private = generate_keypair()
+        message = "message {}".format(count)
+        items.append((public, message, sign(private, message)))
+    assert verify_batch(items) == [True] * len(items)
+    assert verify_batch([]) == []
+
+    public, message, (preimage, pub2) = items[5]
+    items[5] = (public, message, ([preimage[0] + 1] + preimage[1:], pub2))
+    items[2] = (items[2][0], "forged", items[2][2])
+    items.append((public, message, (preimage[1:], pub2)))
+    expected = [True] * len(items)
+    expected[2] = expected[5] = expected[-1] = False
+    with instrumentation.measure() as recorder:
+        assert verify_batch(items) == expected
+    # each well-formed message is hashed once, however often it is rechecked
+    counters = recorder.snapshot()["signature.verify_batch"]["counters"]
+    assert counters["hash_calls"] == len(items) - 1
+    assert [verify(*item) for item in items[:-1]] == expected[:-1]
+    print("Batch verification test complete")
+
+def test_stream_signing():
+    import os
+    import tempfile
+    print("Testing pre-hashed and streamed signatures...")
+    public, private = generate_keypair()
+    message = os.urandom(3 * 1000 + 7)
+    signature = sign(private, message)
+    _file, path = tempfile.mkstemp()
+    try:
+        os.write(_file, message)
+        os.close(_file)
+        hasher = new_hash(parameters=PARAMETERS)
+        hasher.update(message[:100]); hasher.update(message[100:])
+        with open(path, "rb") as _file:
+            mapped = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for source in (path, hasher, mapped, bytearray(message)):
+                    assert hash_message(source, chunk_size=1000) == \
+                           new_hash(message).digest()
+                    assert verify_stream(public, source, signature)
+                assert verify(public, message, sign_stream(private, mapped))
+            finally:
+                mapped.close()
+            assert verify(public, message, sign_stream(private, _file))
+    finally:
+        os.remove(path)
+    digest = new_hash(message).digest()
+    assert verify_digest(public, digest, sign_digest(private, digest))
+    assert not verify_digest(public, new_hash("other").digest(), signature)
+
+    cache = ChallengeCache(2)
+    digests = [new_hash(str(count)).digest() for count in range(3)]
+    for digest in digests + digests[2:]:
+        cache.get(digest)
+    assert len(cache) == 2 and (cache.hits, cache.misses) == (1, 3)
+    cache.clear()
+    assert cache.lookup(digests[0]) is None and len(cache) == 0
+    assert cache.lookup(digests[0]) == cache.get(digests[0])
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.get(digests[0]) == tuple(core.powers(
+        digest_to_scalar(digests[0]), PARAMETERS['q'], PARAMETERS['n']))
+
+    # signing leaves the shared cache to verification
+    challenge_cache.clear()
+    signed = sign(private, "not cached")
+    assert len(challenge_cache) == 0 and challenge_cache.misses == 0
+    assert verify(public, "not cached", signed)
+    print("Stream signing test complete")
+
+def serialize_public_key(public_key, parameters=PARAMETERS):
+    return serialization.encode(serialization.SIGNATURE_PUBLIC_KEY, public_key,
+                                parameters)
+
+def deserialize_public_key(serialized_key, parameters=PARAMETERS):
+    return serialization.decode(serialized_key,
+                                (serialization.SIGNATURE_PUBLIC_KEY, ),
+                                parameters)[1]
+
+def serialize_signature(signature, parameters=PARAMETERS):
+    preimage, pub2 = signature
+    return serialization.encode(serialization.SIGNATURE,
+                                list(preimage) + list(pub2), parameters)
+
+def deserialize_signature(serialized_signature, parameters=PARAMETERS):
+    elements = serialization.decode(serialized_signature,
+                                    (serialization.SIGNATURE, ), parameters)[1]
+    n = parameters['n']
+    return elements[:n], elements[n:]
+
+def test_serialize_deserialize():
+    print("Testing signature.py serialization...")
+    public, private = generate_keypair()
+    serialized_public = serialize_public_key(public)
+    _public = deserialize_public_key(serialized_public)
+    assert _public == public
+
+    signature = sign(private, "unit test")
+    serialized_signature = serialize_signature(signature)
+    _signature = deserialize_signature(serialized_signature)
+    assert _signature == signature
+    assert verify(_public, "unit test", _signature)
+    print("Serialization test complete")
+
 def test_sign_verify():
     import sys
     test_size = 1024
@@ -76,26 +444,14 @@ def test_sign_verify():
         r = "unit test"
         signature = sign(private, r)
         assert verify(public, r, signature)
+        assert verify(public, r, sign(PreparedPrivateKey(private), r))
 
         sys.stdout.write('\b' * 79); sys.stdout.flush()
         progress = (100 * (count / float(test_size)), count, test_size)
         sys.stdout.write("{}% ({}/{})".format(*progress))
         sys.stdout.flush()
 
-    print("\nTesting performance of signatures...")
-    from timeit import default_timer as timestamp
-    before = timestamp()
-    for count in range(test_size):
-        assert verify(public, r, signature)
-    after = timestamp()
-    verify_time = after - before
-
-    before = timestamp()
-    for count in range(test_size):
-        sign(private, r)
-    after = timestamp()
-    sign_time = after - before
-
+    print("")
     import parameters
     N = parameters.N; q_size = parameters.PARAMETERS["q_size"]
     print("sign/verify test complete")
@@ -103,15 +459,11 @@ def test_sign_verify():
     compressed_size = q_size * len(private)
     public_size = q_size * len(public)
     sign_size = (q_size * N) + public_size
-    messages = ["Time taken to produce {} signatures: {} seconds",
-                "Time taken to verify  {} signatures: {} seconds",
-                "Public key size : {} bits ({} bytes)",
+    messages = ["Public key size : {} bits ({} bytes)",
                 "Private key size: {} bits ({} bytes) (compressed)",
                 "Private key size: {} bits ({} bytes) (uncompressed)",
                 "Signature size  : {} bits ({} bytes)"]
-    inserts = [(test_size, sign_time),
-               (test_size, verify_time),
-               (public_size, public_size / 8),
+    inserts = [(public_size, public_size / 8),
                (compressed_size, compressed_size / 8),
                (private_size, private_size / 8),
                (sign_size, sign_size / 8)]
@@ -119,5 +471,6 @@ def test_sign_verify():
         print(message.format(*inserts))
 
 if __name__ == "__main__":
-    #test_serialize_deserialize()
+    test_serialize_deserialize()
+    test_stream_signing()
     test_sign_verify()
@@ -0,0 +1,233 @@
+""" Streaming encryption of byte streams and files with bounded memory.
+
+    usage: python stream.py keygen KEYFILE
+           python stream.py encrypt KEYFILE [INPUT] [OUTPUT] [--processes N]
+           python stream.py decrypt KEYFILE [INPUT] [OUTPUT] [--processes N]
+
+    INPUT and OUTPUT default to stdin and stdout.
+
+    Input is read frame_size bytes at a time and packed into field elements of
+    element_size(q) - 1 bytes, which are always below q. Each element is
+    encrypted as a compressed (seed, scalar) ciphertext.
+
+    Format: MAGIC | frame size (4 bytes, big-endian), then frames of
+        plaintext length (4 bytes, big-endian) | (seed, scalar) per element
+    and a final frame of length 0. Every element is element_size(q) bytes.
+    A reader rejects frames longer than the frame size in the header, and
+    headers above MAX_FRAME_SIZE, before buffering any payload.
+
+    This provides confidentiality only; frames are not authenticated. """
+import argparse
+import struct
+import sys
+
+import encryption
+import parallel
+import serialization
+from aggregate import chunks
+from parameters import PARAMETERS
+from utilities import bytes_to_integer, integer_to_bytes
+
+MAGIC = b"C2S\x01"
+FRAME_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+_LENGTH = struct.Struct(">I")
+
+def plaintext_chunk_size(q):
+    return serialization.element_size(q) - 1
+
+def encrypted_frame_size(length, q):
+    # bytes that follow the frame header for a frame of length plaintext bytes
+    chunk_size = plaintext_chunk_size(q)
+    return 2 * ((length + chunk_size - 1) // chunk_size) * serialization.element_size(q)
+
+def encrypt_frame(key, data, parameters=PARAMETERS):
+    q = parameters['q']
+    chunk_size = plaintext_chunk_size(q)
+    view = memoryview(data)
+    messages = [bytes_to_integer(view[index:index + chunk_size]) for index in
+                range(0, len(view), chunk_size)]
+    ciphertexts = encryption.encrypt_many(key, messages, parameters)
+    elements = [element for ciphertext in ciphertexts for element in ciphertext]
+    return _LENGTH.pack(len(view)) + serialization.pack_elements(elements, q)
+
+def decrypt_frame(key, length, payload, parameters=PARAMETERS):
+    q = parameters['q']
+    chunk_size = plaintext_chunk_size(q)
+    if len(payload) != encrypted_frame_size(length, q):
+        raise ValueError("Invalid frame size")
+    elements = serialization.unpack_elements(payload, q)
+    ciphertexts = [(elements[index], elements[index + 1]) for index in
+                   range(0, len(elements), 2)]
+    messages = encryption.decrypt_many(key, ciphertexts, parameters)
+    output = bytearray()
+    for index, message in enumerate(messages):
+        size = min(chunk_size, length - (index * chunk_size))
+        if message >> (8 * size):
+            raise ValueError("Decrypted chunk does not fit its frame")
+        output += integer_to_bytes(message, size)
+    return bytes(output)
+
+def _read_exactly(infile, count):
+    data = bytearray()
+    while len(data) < count:
+        block = infile.read(count - len(data))
+        if not block:
+            raise ValueError("Truncated stream")
+        data += block
+    return bytes(data)
+
+def read_plaintext(infile, frame_size=FRAME_SIZE):
+    # yields up to frame_size bytes at a time until EOF
+    while True:
+        data = infile.read(frame_size)
+        if not data:
+            return
+        yield data
+
+def read_frames(infile, parameters=PARAMETERS):
+    # yields (length, payload) for every frame of an encrypted stream
+    if _read_exactly(infile, len(MAGIC)) != MAGIC:
+        raise ValueError("Not a crypto2 stream")
+    limit = _LENGTH.unpack(_read_exactly(infile, _LENGTH.size))[0]
+    if not 0 < limit <= MAX_FRAME_SIZE:
+        raise ValueError("Invalid frame size {}".format(limit))
+    q = parameters['q']
+    while True:
+        length = _LENGTH.unpack(_read_exactly(infile, _LENGTH.size))[0]
+        if not length:
+            return
+        if length > limit:
+            raise ValueError("Frame of {} bytes exceeds the frame size {}".format(
+                             length, limit))
+        # the payload is a whole number of (seed, scalar) pairs by construction
+        yield length, _read_exactly(infile, encrypted_frame_size(length, q))
+
+def _encrypt_job(job):
+    key, data = job
+    return encrypt_frame(key, data, parallel.worker_parameters())
+
+def _decrypt_job(job):
+    key, (length, payload) = job
+    return decrypt_frame(key, length, payload, parallel.worker_parameters())
+
+def _pipeline(function, job_function, key, items, parameters, processes):
+    if not processes:
+        for item in items:
+            yield function(key, item, parameters)
+        return
+    # a bounded window of frames is in flight at any time
+    with parallel.Executor(parameters, processes) as executor:
+        for window in chunks(items, 2 * processes):
+            for output in executor.map(job_function, [(key, item) for item in
+                                                      window]):
+                yield output
+
+def encrypt_chunks(key, blocks, parameters=PARAMETERS, processes=0):
+    """ usage: encrypt_chunks(key, blocks, parameters=PARAMETERS,
+                              processes=0) => iterator of encrypted frames
+
+        Encrypts each block of bytes from an iterable into one frame. """
+    return _pipeline(encrypt_frame, _encrypt_job, key, blocks, parameters,
+                     processes)
+
+def decrypt_frames(key, frames, parameters=PARAMETERS, processes=0):
+    """ usage: decrypt_frames(key, frames, parameters=PARAMETERS,
+                              processes=0) => iterator of plaintext chunks
+
+        frames is an iterable of (length, payload) as from read_frames. """
+    def _decrypt(key, frame, parameters):
+        return decrypt_frame(key, frame[0], frame[1], parameters)
+    return _pipeline(_decrypt, _decrypt_job, key, frames, parameters, processes)
+
+def encrypt_stream(key, infile, outfile, parameters=PARAMETERS,
+                   frame_size=FRAME_SIZE, processes=0):
+    if not 0 < frame_size <= MAX_FRAME_SIZE:
+        raise ValueError("frame_size must be between 1 and {}".format(
+                         MAX_FRAME_SIZE))
+    outfile.write(MAGIC + _LENGTH.pack(frame_size))
+    for frame in encrypt_chunks(key, read_plaintext(infile, frame_size),
+                                parameters, processes):
+        outfile.write(frame)
+    outfile.write(_LENGTH.pack(0))
+
+def decrypt_stream(key, infile, outfile, parameters=PARAMETERS, processes=0):
+    for data in decrypt_frames(key, read_frames(infile, parameters), parameters,
+                               processes):
+        outfile.write(data)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="crypto2 stream encryption")
+    parser.add_argument("command", choices=("keygen", "encrypt", "decrypt"))
+    parser.add_argument("keyfile")
+    parser.add_argument("input", nargs='?')
+    parser.add_argument("output", nargs='?')
+    parser.add_argument("--processes", type=int, default=0)
+    parser.add_argument("--frame-size", type=int, default=FRAME_SIZE)
+    arguments = parser.parse_args(argv)
+
+    if arguments.command == "keygen":
+        with open(arguments.keyfile, "wb") as _file:
+            _file.write(encryption.serialize_key(encryption.generate_secret_key()))
+        return 0
+    with open(arguments.keyfile, "rb") as _file:
+        key = encryption.deserialize_key(_file.read())
+    infile = (open(arguments.input, "rb") if arguments.input else
+              getattr(sys.stdin, "buffer", sys.stdin))
+    outfile = (open(arguments.output, "wb") if arguments.output else
+               getattr(sys.stdout, "buffer", sys.stdout))
+    try:
+        if arguments.command == "encrypt":
+            encrypt_stream(key, infile, outfile, frame_size=arguments.frame_size,
+                           processes=arguments.processes)
+        else:
+            decrypt_stream(key, infile, outfile, processes=arguments.processes)
+    finally:
+        if arguments.input:
+            infile.close()
+        if arguments.output:
+            outfile.close()
+    return 0
+
+def test_stream():
+    import io
+    import os
+    print("Testing stream.py...")
+    key = encryption.generate_secret_key()
+    chunk_size = plaintext_chunk_size(PARAMETERS['q'])
+    for size in (0, 1, chunk_size - 1, chunk_size, chunk_size + 1, 1000):
+        data = os.urandom(size)
+        for processes in ((0, 2) if size == 1000 else (0, )):
+            encrypted = io.BytesIO()
+            encrypt_stream(key, io.BytesIO(data), encrypted, frame_size=100,
+                           processes=processes)
+            decrypted = io.BytesIO()
+            decrypt_stream(key, io.BytesIO(encrypted.getvalue()), decrypted,
+                           processes=processes)
+            assert decrypted.getvalue() == data, (size, processes)
+    try:
+        decrypt_stream(key, io.BytesIO(encrypted.getvalue()[:-1]), io.BytesIO())
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Accepted truncated stream")
+
+    # a hostile length is rejected before its payload is read
+    encrypted = encrypted.getvalue()
+    header_size = len(MAGIC) + _LENGTH.size
+    oversized = (encrypted[:header_size] + _LENGTH.pack(101) +
+                 encrypted[header_size + _LENGTH.size:])
+    huge = MAGIC + _LENGTH.pack(MAX_FRAME_SIZE) + _LENGTH.pack(MAX_FRAME_SIZE + 1)
+    bad_header = MAGIC + _LENGTH.pack(MAX_FRAME_SIZE + 1)
+    for stream in (oversized, huge, bad_header, MAGIC + _LENGTH.pack(0)):
+        try:
+            list(read_frames(io.BytesIO(stream)))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Accepted an oversized frame")
+    print("Stream test complete")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,32 @@
 if __name__ == "__main__":
+    import sys
     import encryption
     import core
     import kem
     import signature
-    for module in (encryption, core, kem, signature):
+    import parameters
+    import serialization
+    import backend
+    import keypool
+    import utilities
+    import benchmark
+    import parallel
+    import aggregate
+    import stream
+    import instrumentation
+    import powervector
+    import keystore
+    import linearalgebra
+    import explore
+    import ciphertextbatch
+    modules = (encryption, core, kem, signature, parameters, serialization,
+               backend, keypool, utilities, benchmark, parallel, aggregate,
+               stream, instrumentation, powervector, keystore, linearalgebra,
+               explore, ciphertextbatch)
+    if sys.version_info[0] >= 3:
+        import aio
+        modules += (aio, )
+    for module in modules:
         for name in dir(module):
             if name[:4] == "test":
                 test = getattr(module, name)
@@ -1,8 +1,16 @@
 import random # used in primality testing
-from os import urandom as random_bytes
+from os import urandom
+import binascii
 import hmac
 import hashlib
 import itertools
+import mmap
+import struct
+
+import instrumentation
+from core import powers
+
+_COUNTER = struct.Struct(">Q")
 
 def slide(iterable, x=16):
     """ Yields x entries at a time from iterable """
@@ -11,76 +19,171 @@ def slide(iterable, x=16):
         _position = position * x
         yield iterable[_position:_position + x]
 
+def random_bytes(size_in_bytes):
+    if instrumentation.enabled:
+        instrumentation.count(urandom_calls=1, urandom_bytes=size_in_bytes)
+    return urandom(size_in_bytes)
+
 def random_integer(size_in_bytes):
     return bytes_to_integer(bytearray(random_bytes(size_in_bytes)))
 
 def random_integer_mod_q(size_in_bytes, q):
     return random_integer(size_in_bytes) % q
 
+def random_vector_mod_q(size_in_bytes, q, n):
+    """ usage: random_vector_mod_q(size_in_bytes, q, n) => [scalar, ...]
+
+        Returns n random scalars mod q, each reduced from size_in_bytes bytes.
+        All n scalars are sliced from a single urandom call. """
+    data = memoryview(random_bytes(size_in_bytes * n))
+    return [bytes_to_integer(data[index:index + size_in_bytes]) % q for index in
+            range(0, size_in_bytes * n, size_in_bytes)]
+
 def random_coefficient(r_size, s_max):
     return random_integer_mod_q(r_size, s_max)
 
 def random_vector(parameters):
     r_size = parameters["r_size"]; s_max = parameters["s_max"]
-    return [random_coefficient(parameters) for i in range(parameters['n'])]
+    return random_vector_mod_q(r_size, s_max, parameters['n'])
 
-def compress(vector, q):
-    degree = len(vector)
-    elements = set(vector)
-    assert len(elements) == len(vector), (len(elements), len(vector))
-    for scalar in vector:
-        for k in range(1, degree + 1):
-            if pow(scalar, k, q) not in elements:
+def find_generator(vector, q):
+    """ usage: find_generator(vector, q) => scalar, permutation
+
+        vector must be a permutation of s, ss, ..., s^n mod q with distinct
+        entries. Returns s and the permutation with
+        vector[i] == s^(permutation[i] + 1).
+
+        Every candidate is multiplied forward through a hash index of the
+        entries until a power falls outside it; candidate s^k leaves after
+        about n / k steps, so the search costs about n ln n multiplications. """
+    n = len(vector)
+    positions = dict((value, position) for position, value in enumerate(vector))
+    if len(positions) != n:
+        raise ValueError("Vector entries are not distinct")
+    for candidate in vector:
+        permutation = [None] * n
+        power = candidate
+        for k in range(n):
+            position = positions.get(power)
+            if position is None:
                 break
+            permutation[position] = k
+            power = (power * candidate) % q
         else:
-            break
-    else:
-        raise ValueError("No relation found")
-    return scalar
+            return candidate, permutation
+    raise ValueError("No relation found")
+
+def compress(vector, q):
+    return find_generator(vector, q)[0]
 
 def decompress(scalar, n, q):
-    return [pow(scalar, i, q) for i in range(1, n + 1)]
+    return powers(scalar, q, n)
 
 def compressible_vector(r_size, n, q):
     return decompress(random_integer(r_size), n, q)
 
+def as_bytes(data):
+    if isinstance(data, bytes) or isinstance(data, bytearray):
+        return data
+    return data.encode("utf-8")
+
+def map_file(path):
+    # read-only mmap of path and a memoryview of it
+    with open(path, "rb") as _file:
+        mapped = mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        view = memoryview(mapped)
+    except TypeError:
+        # python 2 mmap only offers the old buffer interface
+        view = memoryview(buffer(mapped))
+    return mapped, view
+
+def unmap_file(mapped, view):
+    try:
+        getattr(view, "release", lambda: None)()
+        mapped.close()
+    except BufferError:
+        # views of the mapping are still alive; it is closed when they are freed
+        pass
+
+def _hmac_prf(key, seed, hash_function="SHA256"):
+    # keyed once; every block copies the keyed state instead of rekeying
+    return hmac.HMAC(as_bytes(key), as_bytes(seed),
+                     getattr(hashlib, hash_function.lower()))
+
+def _block(prf, index):
+    if instrumentation.enabled:
+        instrumentation.count(hash_calls=1)
+    hasher = prf.copy()
+    hasher.update(_COUNTER.pack(index))
+    return hasher.digest()
+
+def psuedorandom_block(key, seed, index, hash_function="SHA256"):
+    """ usage: psuedorandom_block(key, seed, index,
+                                  hash_function="SHA256") => block
+
+        Returns block number index of the key/seed output stream:
+        HMAC(key, seed || 64-bit big-endian index).
+        Blocks are independent, so any block can be computed directly. """
+    return _block(_hmac_prf(key, seed, hash_function), index)
+
 def _hmac_rng(key, seed, hash_function="SHA256"):
-    """ Generates psuedorandom bytes via HMAC. Implementation could be improved to
-        a compliant scheme like HMAC-DRBG. """
-    hasher = hmac.HMAC(key, seed, getattr(hashlib, hash_function.lower()))
-    for counter in (str(number) for number in itertools.count()):
-        yield hasher.digest()
-        hasher.update(key + seed + counter)
+    """ Generates psuedorandom bytes via HMAC in counter mode. """
+    prf = _hmac_prf(key, seed, hash_function)
+    for index in itertools.count():
+        yield _block(prf, index)
 
-def psuedorandom_bytes(key, seed, count, hash_function="SHA256"):
-    """ usage: psuedorandom_bytes(key, seed, count,
-                                  hash_function="SHA256") => psuedorandom bytes
+def psuedorandom_bytes(key, seed, count, hash_function="SHA256", offset=0):
+    """ usage: psuedorandom_bytes(key, seed, count, hash_function="SHA256",
+                                  offset=0) => psuedorandom bytes
 
         Generates count cryptographically secure psuedorandom bytes.
         Bytes are produced deterministically based on key and seed, using
-        hash_function with _hmac_rng. """
-    hash_function = hash_function.lower()
-    generator = _hmac_rng(key, seed, hash_function)
-    output = ''
-    output_size = getattr(hashlib, hash_function)().digest_size
-    iterations, extra = divmod(count, output_size)
-    for round in range(iterations + 1 if extra else iterations):
-        output += next(generator)
-    return output[:count]
-
-def bytes_to_integer(data):
-    output = 0
-    size = len(data)
-    for index in range(size):
-        output |= data[index] << (8 * (size - 1 - index))
-    return output
-
-def integer_to_bytes(integer, _bytes):
-    output = bytearray()
-    #_bytes /= 2
-    for byte in range(_bytes):
-        output.append((integer >> (8 * (_bytes - 1 - byte))) & 255)
-    return output
+        hash_function in counter mode; offset selects where in the output
+        stream to start, so disjoint ranges can be expanded in parallel. """
+    prf = _hmac_prf(key, seed, hash_function)
+    block_size = prf.digest_size
+    first_block, skip = divmod(offset, block_size)
+    block_count = (skip + count + block_size - 1) // block_size
+    output = bytearray(block_count * block_size)
+    for index in range(block_count):
+        position = index * block_size
+        output[position:position + block_size] = _block(prf, first_block + index)
+    return bytes(output[skip:skip + count])
+
+def expand_to_scalars(key, seed, count, q, size_in_bytes=None,
+                      hash_function="SHA256", start=0):
+    """ usage: expand_to_scalars(key, seed, count, q, size_in_bytes=None,
+                                 hash_function="SHA256", start=0) => [scalar, ...]
+
+        Deterministically derives count scalars mod q from key and seed.
+        Each scalar is reduced from size_in_bytes bytes of output, by default
+        16 bytes wider than q to make the bias negligible.
+        Scalar i only depends on its own range of the output stream, so
+        start can be used to derive scalars start, start + 1, ... directly. """
+    if size_in_bytes is None:
+        size_in_bytes = ((q.bit_length() + 7) // 8) + 16
+    data = memoryview(psuedorandom_bytes(key, seed, count * size_in_bytes,
+                                         hash_function, start * size_in_bytes))
+    return [bytes_to_integer(data[index:index + size_in_bytes]) % q for index in
+            range(0, count * size_in_bytes, size_in_bytes)]
+
+if hasattr(int, "from_bytes"):
+    def bytes_to_integer(data):
+        return int.from_bytes(data, "big")
+
+    def integer_to_bytes(integer, _bytes):
+        integer &= (1 << (8 * _bytes)) - 1
+        return bytearray(integer.to_bytes(_bytes, "big"))
+else:
+    def bytes_to_integer(data):
+        return int(binascii.hexlify(data), 16) if len(data) else 0
+
+    def integer_to_bytes(integer, _bytes):
+        if not _bytes:
+            return bytearray()
+        integer &= (1 << (8 * _bytes)) - 1
+        return bytearray(binascii.unhexlify("%0*x" % (2 * _bytes, integer)))
 
 def is_prime(n, _mrpt_num_trials=10): # from https://rosettacode.org/wiki/Miller%E2%80%93Rabin_primality_test#Python
     assert n >= 2
@@ -118,3 +221,40 @@ def is_prime(n, _mrpt_num_trials=10): # from https://rosettacode.org/wiki/Miller
             return False
 
     return True # no base tested showed n as composite
+
+def test_conversions():
+    print("Testing utilities.py conversions...")
+    for size in (0, 1, 32, 33, 384):
+        data = bytearray(random_bytes(size))
+        integer = 0
+        for byte in data:
+            integer = (integer << 8) | byte
+        assert bytes_to_integer(data) == integer
+        assert bytes_to_integer(memoryview(data)) == integer
+        assert integer_to_bytes(integer, size) == data
+        assert integer_to_bytes(integer + (1 << (8 * size)), size) == data
+    assert integer_to_bytes(-1, 2) == bytearray(b"\xff\xff")
+    q = (2 ** 256) + 297
+    vector = random_vector_mod_q(40, q, 23)
+    assert len(vector) == 23 and all(0 <= scalar < q for scalar in vector)
+    assert len(set(vector)) == 23
+    print("Conversion test complete")
+
+def test_psuedorandom_bytes():
+    print("Testing utilities.py psuedorandom generation...")
+    key, seed = "test key", "test seed"
+    output = psuedorandom_bytes(key, seed, 1000)
+    assert len(output) == 1000
+    assert psuedorandom_bytes(key, seed, 1000) == output
+    assert psuedorandom_bytes(key, "other seed", 1000) != output
+    assert psuedorandom_bytes(key, seed, 100, offset=450) == output[450:550]
+    blocks = b''.join(psuedorandom_block(key, seed, index) for index in range(4))
+    assert blocks == output[:128]
+    generator = _hmac_rng(key, seed)
+    assert b''.join(next(generator) for index in range(4)) == blocks
+
+    q = (2 ** 256) + 297
+    scalars = expand_to_scalars(key, seed, 16, q)
+    assert all(0 <= scalar < q for scalar in scalars)
+    assert expand_to_scalars(key, seed, 6, q, start=10) == scalars[10:]
+    print("Psuedorandom generation test complete")